@@ -0,0 +1,143 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import runpy
+import shlex
+import sys
+import time
+import traceback
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Script rendering each type of input file, and its input file option
+SCRIPTS = {
+    '.ps': ('postscript_to_xpm.py', '-f'),
+    '.pol': ('poly_fill_from_file.py', '-f'),
+    '.bze': ('bezier_from_file.py', '-i'),
+}
+
+# Scripts that can be given explicitly, and their input file option
+INPUT_OPTIONS = {
+    'postscript_to_xpm.py': '-f',
+    'poly_fill_from_file.py': '-f',
+    'clipped_poly_sutherland_hodgman.py': '-f',
+    'bezier_from_file.py': '-i',
+}
+
+
+def job(arguments, options=()):
+    """
+    Returns the input file, the script and its command line arguments
+    rendering the input file described by the arguments of a manifest line,
+    of the form: [script.py] input [options]
+    The script is picked by the input file's extension unless given, and the
+    output file defaults to the input file with an .xpm extension
+    """
+
+    arguments = list(arguments)
+    if arguments and arguments[0] in INPUT_OPTIONS:
+        script = arguments.pop(0)
+        input_option = INPUT_OPTIONS[script]
+    elif arguments:
+        extension = os.path.splitext(arguments[0])[1]
+        if extension not in SCRIPTS:
+            raise ValueError('No script renders %s files' % extension)
+        script, input_option = SCRIPTS[extension]
+    else:
+        raise ValueError('Empty manifest line')
+
+    path, arguments = arguments[0], list(options) + arguments[1:]
+    if '-o' not in arguments and '--output' not in arguments:
+        arguments += ['-o', os.path.splitext(path)[0] + '.xpm']
+    return path, script, [input_option, path] + arguments
+
+
+def _start_worker():
+    """
+    Imports everything the scripts use once per worker process
+    """
+
+    sys.path.insert(0, HERE)
+    import clipping
+    import display_list
+    import postscript
+    import tiles
+    import xpm
+
+
+def render(task):
+    """
+    Runs a script rendering an input file in the worker process, returning
+    the input file, the time it took and the error it failed with, if any
+    """
+
+    path, script, arguments = task
+    argv = sys.argv
+    sys.argv = [script] + arguments
+    start = time.time()
+    try:
+        runpy.run_path(os.path.join(HERE, script), run_name='__main__')
+        error = None
+    except SystemExit as e:
+        error = 'exited with status %s' % e.code if e.code else None
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+    finally:
+        sys.argv = argv
+    return path, time.time() - start, error
+
+
+# Define command line arguments and parse them
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    'inputs', nargs='*',
+    help='Input files (.ps, .pol or .bze), or glob patterns matching them')
+parser.add_argument(
+    '-m', '--manifest', type=argparse.FileType('r'),
+    help='File listing one input file per line, optionally preceded by the '
+         'script rendering it and followed by its own options')
+parser.add_argument(
+    '-O', '--options', default='',
+    help='Options given to the script rendering each input file')
+parser.add_argument(
+    '-j', '--processes', type=int,
+    help='Number of worker processes (defaults to the number of CPUs)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    options = shlex.split(args.options)
+
+    lines = [[path] for pattern in args.inputs
+             for path in sorted(glob.glob(pattern)) or [pattern]]
+    if args.manifest:
+        lines += [shlex.split(line) for line in args.manifest
+                  if line.strip() and not line.startswith('#')]
+
+    tasks = []
+    failures = []
+    for line in lines:
+        try:
+            tasks.append(job(line, options))
+        except ValueError as e:
+            failures.append((' '.join(line), 0, str(e)))
+
+    pool = multiprocessing.Pool(args.processes, _start_worker)
+    try:
+        results = pool.imap(render, tasks)
+        for path, seconds, error in results:
+            if error:
+                failures.append((path, seconds, error))
+                print('%s: failed after %.3fs (%s)' % (path, seconds, error))
+            else:
+                print('%s: %.3fs' % (path, seconds))
+    finally:
+        pool.close()
+        pool.join()
+
+    print('%s rendered, %s failed' % (len(lines) - len(failures),
+                                      len(failures)))
+    for path, _, error in failures:
+        print('  %s: %s' % (path, error))
+    sys.exit(1 if failures else 0)
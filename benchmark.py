@@ -0,0 +1,388 @@
+import argparse
+import filecmp
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from xpm import XPM, Color, numpy
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+COLOR = Color('#FF0000', 'R')
+
+# Example scripts reproducing the checked-in images, with their arguments
+# (the arguments poly_fill_from_file.xpm was rendered with are not known)
+GOLDEN = [
+    ('bezier.py', [], 'bezier.xpm'),
+    ('clipped_line.py', [], 'clipped_line.xpm'),
+    ('gradient.py', [], 'gradient.xpm'),
+    ('line.py', [], 'line.xpm'),
+    ('poly.py', [], 'poly.xpm'),
+    ('poly_fill.py', [], 'poly_fill.xpm'),
+    ('bezier_from_file.py',
+     ['-i', 'bezier_from_file.bze', '-w', '200', '-h', '200', '-p', '0.02'],
+     'bezier_from_file.xpm'),
+    ('postscript_to_xpm.py',
+     ['-f', 'postscript_to_xpm.ps', '-w', '200', '-h', '200', '--no-cache'],
+     'postscript_to_xpm.xpm'),
+    ('clipped_poly_sutherland_hodgman.py',
+     ['-f', 'clipped_poly_sutherland_hodgman.pol', '-w', '200', '-h', '200',
+      '-wl', '50', '-wt', '50', '-wr', '150', '-wb', '150'],
+     'clipped_poly_sutherland_hodgman.xpm'),
+]
+
+
+def _segments(rng, size, count):
+    return [[rng.randrange(size), rng.randrange(size),
+             rng.randrange(size), rng.randrange(size)] for _ in range(count)]
+
+
+def _polys(rng, size, count, corners=8):
+    """
+    Returns random star-shaped polys, small enough for filling them not to
+    dwarf everything else
+    """
+
+    radius = max(2, size // 20)
+    polys = []
+    for _ in range(count):
+        cx, cy = rng.randrange(size), rng.randrange(size)
+        polys.append([
+            [min(size - 1, max(0, int(cx + r * math.cos(a)))),
+             min(size - 1, max(0, int(cy + r * math.sin(a))))]
+            for a, r in ((2 * math.pi * i / corners,
+                          rng.uniform(radius / 4., radius))
+                         for i in range(corners))])
+    return polys
+
+
+def _rects(rng, size, count):
+    side = max(1, size // 10)
+    rects = []
+    for _ in range(count):
+        x, y = rng.randrange(size), rng.randrange(size)
+        rects.append([x, y, x + rng.randrange(side), y + rng.randrange(side)])
+    return rects
+
+
+def _curves(rng, size, count):
+    return [[[rng.randrange(size), rng.randrange(size)] for _ in range(4)]
+            for _ in range(count)]
+
+
+def _clip(size):
+    return (size // 4, size // 4, 3 * size // 4, 3 * size // 4)
+
+
+def _shrink(image, size):
+    # Keeps transformed points within the image
+    image.scale(0, 0, 0.5, 0.5)
+    image.translate(size // 4, size // 4)
+
+
+def _complex_lines(clip=False, transforms=False):
+    def setup(image, rng, size, count):
+        if transforms:
+            _shrink(image, size)
+        return _segments(rng, size, count), _clip(size) if clip else None
+
+    def run(image, data):
+        segments, window = data
+        for x1, y1, x2, y2 in segments:
+            image.complex_line(x1, y1, x2, y2, COLOR, clip=window,
+                               transforms=transforms)
+    return setup, run
+
+
+def _setup_image(image, rng, size, count):
+    return None
+
+
+def _setup_drawn(image, rng, size, count):
+    image.lines(_segments(rng, size, count), COLOR)
+
+
+def _run_set(image, points):
+    for x, y in points:
+        image.set(x, y, COLOR)
+
+
+def _run_line(image, segments):
+    for x1, y1, x2, y2 in segments:
+        image.line(x1, y1, x2, y2, COLOR)
+
+
+def _run_poly(image, polys):
+    for vertices in polys:
+        image.poly(vertices, COLOR, fill=COLOR)
+
+
+def _run_complex_poly(image, data):
+    polys, window = data
+    for vertices in polys:
+        image.complex_poly(vertices, COLOR, fill=COLOR, clip=window)
+
+
+def _run_bezier(image, curves):
+    for points in curves:
+        image.bezier(points, 0.01, COLOR)
+
+
+def _run_fill_rect(image, rects):
+    for x1, y1, x2, y2 in rects:
+        image.fill_rect(x1, y1, x2, y2, COLOR)
+
+
+def _setup_blit(image, rng, size, count):
+    sprite = XPM(32, 32, image.compact)
+    sprite.poly([[0, 16], [16, 31], [31, 16], [16, 0]], COLOR, fill=COLOR)
+    return sprite, [(rng.randrange(-16, size), rng.randrange(-16, size))
+                    for _ in range(count)]
+
+
+def _run_blit(image, data):
+    sprite, positions = data
+    for x, y in positions:
+        image.blit(sprite, x, y)
+
+
+def _run_export(image, data):
+    image.export(data, autofill=True)
+
+
+# Benchmarks by name: how to set an image up for them (untimed), what to time,
+# and whether they draw a given number of primitives
+BENCHMARKS = {
+    'init': (None, None, False),
+    'set': (lambda image, rng, size, count:
+            [(rng.randrange(size), rng.randrange(size))
+             for _ in range(count)],
+            _run_set, True),
+    'line': (lambda image, rng, size, count: _segments(rng, size, count),
+             _run_line, True),
+    'lines': (lambda image, rng, size, count: _segments(rng, size, count),
+              lambda image, segments: image.lines(segments, COLOR), True),
+    'complex_line': _complex_lines() + (True,),
+    'complex_line_clip': _complex_lines(clip=True) + (True,),
+    'complex_line_transforms': _complex_lines(transforms=True) + (True,),
+    'complex_line_clip_transforms':
+        _complex_lines(clip=True, transforms=True) + (True,),
+    'poly': (lambda image, rng, size, count: _polys(rng, size, count),
+             _run_poly, True),
+    'fill_polys': (lambda image, rng, size, count: _polys(rng, size, count),
+                   lambda image, polys: image.fill_polys(polys, COLOR), True),
+    'complex_poly': (lambda image, rng, size, count:
+                     (_polys(rng, size, count), _clip(size)),
+                     _run_complex_poly, True),
+    'bezier': (lambda image, rng, size, count: _curves(rng, size, count),
+               _run_bezier, True),
+    'beziers': (lambda image, rng, size, count: _curves(rng, size, count),
+                lambda image, curves: image.beziers(curves, 0.01, COLOR),
+                True),
+    'fill_rect': (lambda image, rng, size, count: _rects(rng, size, count),
+                  _run_fill_rect, True),
+    'blit': (_setup_blit, _run_blit, True),
+    'autofill': (_setup_image, lambda image, data: image.autofill(), False),
+    'export': (None, _run_export, False),
+}
+
+
+def painted(image):
+    """
+    Returns the number of pixels of an image that are set
+    """
+
+    if image.compact:
+        return int(numpy.count_nonzero(image.pixels))
+    return sum(pixel is not None for row in image.pixels for pixel in row)
+
+
+def measure(case):
+    """
+    Runs a benchmark case, of the form (name, size, count, seed, compact),
+    in a process of its own, returning its results: the time it took, the
+    number of pixels it set (all pixels of the image for init, autofill and
+    export) per second and the peak memory of the process, in bytes
+    """
+
+    name, size, count, seed, compact = case
+    setup, run, counted = BENCHMARKS[name]
+    rng = random.Random(seed)
+
+    if name == 'init':
+        start = time.time()
+        image = XPM(size, size, compact)
+        seconds = time.time() - start
+        pixels = size * size
+    else:
+        image = XPM(size, size, compact)
+        if name == 'export':
+            _setup_drawn(image, rng, size, count or 1000)
+            handle, data = tempfile.mkstemp(suffix='.xpm')
+            os.close(handle)
+        else:
+            data = setup(image, rng, size, count)
+
+        start = time.time()
+        run(image, data)
+        seconds = time.time() - start
+
+        if name == 'export':
+            os.remove(data)
+        pixels = painted(image) if counted else size * size
+
+    # Linux reports the peak resident size in kilobytes, macOS in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+
+    return {
+        'benchmark': name,
+        'size': size,
+        'count': count if counted else None,
+        'compact': image.compact,
+        'seconds': seconds,
+        'pixels': pixels,
+        'pixels_per_second': pixels / seconds if seconds else None,
+        'peak_memory': peak,
+    }
+
+
+def golden():
+    """
+    Renders the checked-in images again with the example scripts, returning
+    whether each one is still identical to its checked-in version
+    """
+
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        for script, arguments, output in GOLDEN:
+            arguments = [os.path.join(HERE, argument)
+                         if os.path.exists(os.path.join(HERE, argument))
+                         else argument for argument in arguments]
+            if arguments:
+                arguments += ['-o', output]
+            status = subprocess.call(
+                [sys.executable, os.path.join(HERE, script)] + arguments,
+                cwd=directory)
+            results[output] = status == 0 and filecmp.cmp(
+                os.path.join(directory, output), os.path.join(HERE, output),
+                shallow=False)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(results, previous):
+    """
+    Prints the speed of each benchmark case relative to previous results
+    """
+
+    def key(result):
+        return (result['benchmark'], result['size'], result['count'],
+                result['compact'])
+
+    before = dict((key(result), result) for result in previous['results'])
+    for result in results['results']:
+        old = before.get(key(result))
+        if old and old['seconds'] and result['seconds']:
+            print('%-30s %5s %8s  x%.2f' % (
+                result['benchmark'], result['size'], result['count'] or '',
+                old['seconds'] / result['seconds']))
+
+
+# Define command line arguments and parse them
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '-b', '--benchmarks', default=','.join(sorted(BENCHMARKS)),
+    help='Comma separated benchmarks to run (defaults to all of them: %s)'
+         % ', '.join(sorted(BENCHMARKS)))
+parser.add_argument(
+    '-s', '--sizes', default='50,500,2000,8000',
+    help='Comma separated widths (and heights) of the images')
+parser.add_argument(
+    '-n', '--counts', default='100,10000',
+    help='Comma separated numbers of primitives drawn (up to 1e6)')
+parser.add_argument(
+    '-c', '--compact', choices=('auto', 'yes', 'no'), default='auto',
+    help='Whether images are compact (by default, depending on their size)')
+parser.add_argument(
+    '-r', '--repeat', type=int, default=1,
+    help='Number of runs of each case, the fastest of which is kept')
+parser.add_argument('--seed', type=int, default=0, help='Random seed')
+parser.add_argument(
+    '-o', '--output', default='benchmark.json', help='Output file (JSON)')
+parser.add_argument(
+    '--compare', type=argparse.FileType('r'),
+    help='Results of a previous run (JSON) to compare speeds with')
+parser.add_argument(
+    '--no-golden', action='store_true',
+    help='Do not check that the example scripts still render the checked-in '
+         'images')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    compact = {'auto': None, 'yes': True, 'no': False}[args.compact]
+
+    cases = [(name, size, count, args.seed, compact)
+             for name in args.benchmarks.split(',')
+             for size in map(int, args.sizes.split(','))
+             for count in ([int(float(count))
+                            for count in args.counts.split(',')]
+                           if BENCHMARKS[name][2] else [None])]
+
+    results = {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': [],
+    }
+    try:
+        results['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        results['commit'] = None
+
+    for case in cases:
+        # Each run happens in a fresh process, so that its peak memory is
+        # its own
+        runs = []
+        for _ in range(args.repeat):
+            pool = multiprocessing.Pool(1)
+            try:
+                runs.append(pool.apply(measure, (case,)))
+            finally:
+                pool.close()
+                pool.join()
+        result = min(runs, key=lambda result: result['seconds'])
+        results['results'].append(result)
+        print('%-30s %5s %8s %10.4fs %14s px/s %8.1f MB' % (
+            result['benchmark'], result['size'], result['count'] or '',
+            result['seconds'],
+            '%.0f' % result['pixels_per_second']
+            if result['pixels_per_second'] else '-',
+            result['peak_memory'] / 1e6))
+
+    if not args.no_golden:
+        results['golden'] = golden()
+        for output, identical in sorted(results['golden'].items()):
+            print('%-40s %s' % (output, 'ok' if identical else 'DIFFERENT'))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        compare(results, json.load(args.compare))
+
+    sys.exit(0 if all(results.get('golden', {}).values()) else 1)
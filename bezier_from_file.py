@@ -1,4 +1,5 @@
 import argparse
+import sys
 from xpm import XPM, Color
 
 
@@ -6,7 +7,8 @@ from xpm import XPM, Color
 parser = argparse.ArgumentParser(add_help=False)
 parser.add_argument(
     '-i', '--file',
-    type=argparse.FileType('r'), help='Input file (of .bze extension)')
+    type=argparse.FileType('r'),
+    help='Input file (of .bze extension), with a Curve line between curves')
 parser.add_argument(
     '-w', '--width',
     type=int, help='Width of XPM image')
@@ -15,22 +17,38 @@ parser.add_argument(
     type=int, help='Height of XPM image')
 parser.add_argument(
     '-o', '--output',
-    help='Output file (of XPM type)')
+    help='Output file (of XPM type, or PPM or PNG by its extension)')
 parser.add_argument(
     '-p', '--step',
     type=float, help='Step for drawing Bezier curves')
+parser.add_argument(
+    '--stats', action='store_true',
+    help='Print drawing counters and stage timings to standard error')
 args = parser.parse_args()
 
 # Keep only valid lines from input file (the ones ending with Point),
 # remove newline characters, split the valid lines to the 2 coordinates they
 # contain, and cast them to integers
-points = [map(int, line.replace('Point\n', '').replace(' Point \n', '').split())
-         for line in list(args.file)
-         if line.endswith((' Point\n', ' Point \n'))]
+# A line reading Curve ends the curve the previous points belong to, so that
+# a file may hold many curves
+curves = [[]]
+for line in args.file:
+    if line.strip() == 'Curve':
+        curves.append([])
+    elif line.endswith((' Point\n', ' Point \n')):
+        curves[-1].append(
+            map(int, line.replace('Point\n', '').replace(' Point \n', '')
+                .split()))
+curves = [points for points in curves if points]
 
 image = XPM(args.width, args.height)
-image.bezier(
-    points=points,
+if args.stats:
+    image.instrument()
+image.beziers(
+    curves=curves,
     step=args.step,
     color=Color('#FF0000', 'R'))
 image.export(args.output, autofill=True)
+
+if args.stats:
+    sys.stderr.write(image.report())
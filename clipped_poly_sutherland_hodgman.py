@@ -1,4 +1,5 @@
 import argparse
+import sys
 from xpm import XPM, Color
 
 
@@ -15,7 +16,7 @@ parser.add_argument(
     type=int, help='Height of XPM image')
 parser.add_argument(
     '-o', '--output',
-    help='Output file (of XPM type)')
+    help='Output file (of XPM type, or PPM or PNG by its extension)')
 parser.add_argument(
     '-wl', '--window-left',
     type=int, help='Left limit of clipping rectangle')
@@ -28,6 +29,9 @@ parser.add_argument(
 parser.add_argument(
     '-wb', '--window-bottom',
     type=int, help='Bottom limit of clipping rectangle')
+parser.add_argument(
+    '--stats', action='store_true',
+    help='Print drawing counters and stage timings to standard error')
 args = parser.parse_args()
 
 # Vertices are stored one per line in a .pol file, with x and y coords
@@ -40,9 +44,14 @@ clipping = (args.window_left and args.window_top and
             args.window_right and args.window_bottom)
 
 image = XPM(args.width, args.height)
+if args.stats:
+    image.instrument()
 image.complex_poly(
     vertices=vertices,
     color=Color('#FF0000', 'R'),
     clip=(args.window_left, args.window_bottom,
           args.window_right, args.window_top) if clipping else None)
 image.export(args.output, autofill=True)
+
+if args.stats:
+    sys.stderr.write(image.report())
@@ -0,0 +1,181 @@
+import numpy
+
+
+# Outcodes of points lying outside the clip window
+LEFT = 1
+RIGHT = 2
+BELOW = 4
+ABOVE = 8
+
+
+def outcodes(x, y, clip):
+    """
+    Returns the Cohen-Sutherland outcodes of all points (x[i], y[i]) with
+    respect to a rectangle having its diagonal from (xmin, ymin) to
+    (xmax, ymax)
+    """
+
+    xmin, ymin, xmax, ymax = clip
+    return (numpy.where(x < xmin, LEFT, numpy.where(x > xmax, RIGHT, 0)) |
+            numpy.where(y < ymin, BELOW, numpy.where(y > ymax, ABOVE, 0)))
+
+
+def clip_lines(segments, clip):
+    """
+    Clips many lines at once to a rectangle having its diagonal from
+    (xmin, ymin) to (xmax, ymax), the same way `XPM.complex_line` does
+    Lines entirely outside the rectangle are dropped and lines entirely
+    inside it are kept as they are; only the remaining ones are clipped, one
+    rectangle edge per pass
+    `segments` must be of the form: [[x1, y1, x2, y2], ...] (or an Nx4
+    array) and an Nx4 array of the clipped lines is returned
+    """
+
+    try:
+        xmin, ymin, xmax, ymax = clip
+    except ValueError:
+        raise ValueError('Clip argument requires 4 elements')
+
+    segments = numpy.array(segments, dtype=numpy.int64).reshape(-1, 4)
+    outcode1 = outcodes(segments[:, 0], segments[:, 1], clip)
+    outcode2 = outcodes(segments[:, 2], segments[:, 3], clip)
+
+    # Trivially rejected lines are dropped right away
+    keep = (outcode1 & outcode2) == 0
+    segments, outcode1, outcode2 = (
+        segments[keep], outcode1[keep], outcode2[keep])
+
+    pending = (outcode1 | outcode2) != 0
+    while pending.any():
+        x1, y1, x2, y2 = segments[pending].T
+        code1, code2 = outcode1[pending], outcode2[pending]
+
+        # Move the end lying outside onto the edge it lies beyond, using the
+        # same (integer) arithmetic as `XPM.complex_line`
+        code = numpy.where(code1 != 0, code1, code2)
+        above = (code & ABOVE) != 0
+        below = ~above & ((code & BELOW) != 0)
+        right = ~above & ~below & ((code & RIGHT) != 0)
+        left = ~above & ~below & ~right
+
+        dx, dy = x2 - x1, y2 - y1
+        safe_dx = numpy.where(dx != 0, dx, 1)
+        safe_dy = numpy.where(dy != 0, dy, 1)
+        x = numpy.select(
+            [above, below, right],
+            [x1 + dx * (ymax - y1) // safe_dy,
+             x1 + dx * (ymin - y1) // safe_dy,
+             xmax],
+            xmin)
+        y = numpy.select(
+            [above, below, right],
+            [ymax, ymin, y1 + dy * (xmax - x1) // safe_dx],
+            y1 + dy * (xmin - x1) // safe_dx)
+
+        first = code == code1
+        x1, y1 = numpy.where(first, x, x1), numpy.where(first, y, y1)
+        x2, y2 = numpy.where(first, x2, x), numpy.where(first, y2, y)
+        segments[pending] = numpy.column_stack((x1, y1, x2, y2))
+        outcode1[pending] = outcodes(x1, y1, clip)
+        outcode2[pending] = outcodes(x2, y2, clip)
+
+        rejected = (outcode1 & outcode2) != 0
+        if rejected.any():
+            segments, outcode1, outcode2 = (
+                segments[~rejected], outcode1[~rejected], outcode2[~rejected])
+        pending = (outcode1 | outcode2) != 0
+
+    return segments
+
+
+def clip_polys(polys, clip):
+    """
+    Clips many polys at once to a rectangle having its diagonal from
+    (xmin, ymin) to (xmax, ymax), using the Sutherland-Hodgman algorithm
+    Polys whose bounding box lies entirely inside the rectangle are kept as
+    they are and polys whose bounding box lies entirely outside it are
+    dropped; the remaining ones are clipped together, one rectangle edge per
+    pass
+    `polys` must be of the form: [[[x1, y1], [x2, y2], ...], ...] and a list
+    of the clipped polys' vertices, of the same form, is returned (with an
+    empty list for each poly entirely clipped away)
+    """
+
+    try:
+        xmin, ymin, xmax, ymax = clip
+    except ValueError:
+        raise ValueError('Clip argument requires 4 elements')
+    xmin, xmax = sorted((xmin, xmax))
+    ymin, ymax = sorted((ymin, ymax))
+
+    clipped = [[] for _ in polys]
+    polys = [(i, numpy.array(poly, dtype=numpy.int64).reshape(-1, 2))
+             for i, poly in enumerate(polys) if len(poly)]
+    if not polys:
+        return clipped
+
+    indexes = numpy.array([i for i, _ in polys])
+    counts = numpy.array([len(poly) for _, poly in polys])
+    points = numpy.concatenate([poly for _, poly in polys])
+    starts = numpy.cumsum(counts) - counts
+
+    # Bounding box fast paths
+    lower = numpy.minimum.reduceat(points, starts)
+    upper = numpy.maximum.reduceat(points, starts)
+    inside = ((lower[:, 0] >= xmin) & (upper[:, 0] <= xmax) &
+              (lower[:, 1] >= ymin) & (upper[:, 1] <= ymax))
+    outside = ((upper[:, 0] < xmin) | (lower[:, 0] > xmax) |
+               (upper[:, 1] < ymin) | (lower[:, 1] > ymax))
+    for (i, poly), poly_inside in zip(polys, inside):
+        if poly_inside:
+            clipped[i] = poly.tolist()
+
+    keep = numpy.repeat(~inside & ~outside, counts)
+    points = points[keep]
+    ids = numpy.repeat(indexes, counts)[keep]
+
+    # Each pass keeps the side of one rectangle edge: axis, bound and whether
+    # points inside lie above it
+    for axis, bound, above in ((1, ymax, False), (0, xmin, True),
+                               (1, ymin, True), (0, xmax, False)):
+        if not len(points):
+            break
+
+        if above:
+            inside = points[:, axis] >= bound
+        else:
+            inside = points[:, axis] <= bound
+
+        # Previous vertex of each vertex, wrapping around within each poly
+        first = numpy.concatenate(([True], ids[1:] != ids[:-1]))
+        last = numpy.concatenate((ids[1:] != ids[:-1], [True]))
+        previous = numpy.arange(len(points)) - 1
+        previous[first] = numpy.flatnonzero(last)
+
+        start, end = points[previous], points
+        crossing = inside != inside[previous]
+
+        # Intersections of crossing edges with the rectangle edge, truncated
+        # to integers
+        other = 1 - axis
+        delta = end[:, axis] - start[:, axis]
+        delta[delta == 0] = 1
+        intersections = numpy.empty_like(points)
+        intersections[:, axis] = bound
+        intersections[:, other] = numpy.trunc(
+            start[:, other] + 1. * (end[:, other] - start[:, other]) *
+            (bound - start[:, axis]) / delta)
+
+        # Each vertex emits the intersection of the edge ending in it, if
+        # any, followed by itself, if inside
+        emitted = numpy.column_stack((crossing, inside)).ravel()
+        points = numpy.stack((intersections, end), axis=1).reshape(-1, 2)
+        points = points[emitted]
+        ids = numpy.repeat(ids, 2)[emitted]
+
+    if len(points):
+        starts = numpy.flatnonzero(
+            numpy.concatenate(([True], ids[1:] != ids[:-1])))
+        for start, poly in zip(starts, numpy.split(points, starts[1:])):
+            clipped[ids[start]] = poly.tolist()
+    return clipped
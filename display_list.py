@@ -0,0 +1,240 @@
+from collections import defaultdict
+import time
+import numpy
+from clipping import clip_lines, outcodes
+from xpm import Matrix, Transformable, bezier_curve
+
+
+class DisplayList(Transformable):
+    def __init__(self, cell_size=64):
+        """
+        Initializes an empty display list, which records primitives once so
+        that any window of them can be drawn on images later on
+        Recorded primitives are indexed by the cells of a uniform grid of
+        `cell_size` x `cell_size` they overlap: the cells lines touch, and
+        the cells the bounding boxes of polys overlap
+        """
+
+        self.cell_size = cell_size
+        self.primitives = []
+        self.grid = defaultdict(list)
+        self.transforms = Matrix.identity(3)
+
+    def clear(self):
+        """
+        Forgets all recorded primitives, keeping transforms
+        """
+
+        self.primitives = []
+        self.grid = defaultdict(list)
+
+    def line(self, x1, y1, x2, y2, color):
+        """
+        Records a colored line from (x1, y1) to (x2, y2)
+        """
+
+        self.lines([[x1, y1, x2, y2]], color)
+
+    def lines(self, segments, color):
+        """
+        Records many colored lines at once
+        `segments` must be of the form: [[x1, y1, x2, y2], ...] (or an Nx4
+        array)
+        """
+
+        segments = self.apply_transforms(
+            numpy.reshape(segments, (-1, 2))).reshape(-1, 4)
+        if not len(segments):
+            return
+
+        self._add(('lines', segments, color, {}),
+                  *self._segment_cells(segments))
+
+    def poly(self, vertices, color, fill=None, winding='evenodd',
+             contours=()):
+        """
+        Records a colored poly with lines computed from given vertices,
+        optionally filled with given color, along with further contours (see
+        `XPM.poly`)
+        `vertices` must be of the form: [[x1, y1], [x2, y2], ...]
+        """
+
+        vertices = self.apply_transforms(vertices)
+        contours = [self.apply_transforms(contour) for contour in contours]
+        points = numpy.concatenate([vertices] + contours)
+        lower = (points.min(axis=0) // self.cell_size).astype(int)
+        upper = (points.max(axis=0) // self.cell_size).astype(int)
+        cells_x, cells_y = numpy.mgrid[lower[0]:upper[0]+1,
+                                       lower[1]:upper[1]+1].reshape(2, -1)
+        self._add(('poly', vertices.tolist(), color,
+                   {'fill': fill, 'winding': winding,
+                    'contours': [contour.tolist() for contour in contours]}),
+                  numpy.zeros(len(cells_x), dtype=int), cells_x, cells_y)
+
+    def bezier(self, points, step, color, tolerance=None):
+        """
+        Records a colored Bezier curve (see `XPM.bezier`), as the lines it is
+        drawn with
+        """
+
+        points = self.apply_transforms(points)
+        if self.counters is not None:
+            start = time.time()
+        curve = bezier_curve(points, step, tolerance)
+        if self.counters is not None:
+            self.counters['bezier_samples'] += len(curve)
+            self.timings['bezier'] += time.time() - start
+
+        if len(curve) == 1:
+            self.lines(numpy.hstack((curve, curve)), color)
+        else:
+            self.lines(numpy.column_stack((curve[:-1], curve[1:])), color)
+
+    def _segment_cells(self, segments):
+        """
+        Returns the grid cells segments cross or touch, as the indexes of
+        the segments and the cells (x and y), walking each segment
+        over the slabs of cells along x it spans, and over the cells along y
+        its part in each slab spans
+        """
+
+        size = self.cell_size
+        x1, y1, x2, y2 = numpy.asarray(segments, dtype=float).T
+        xmin, xmax = numpy.minimum(x1, x2), numpy.maximum(x1, x2)
+        ymin, ymax = numpy.minimum(y1, y2), numpy.maximum(y1, y2)
+
+        lower = (xmin // size).astype(int)
+        element, offset = _spread((xmax // size).astype(int) - lower + 1)
+        slab = lower[element] + offset
+
+        # Where the segment enters and leaves each slab; segments with a
+        # single x span their whole y bounds in their single slab
+        xa = numpy.maximum(xmin[element], slab * size)
+        xb = numpy.minimum(xmax[element], (slab + 1) * size)
+        dx, dy = (x2 - x1)[element], (y2 - y1)[element]
+        single = dx == 0
+        slope = numpy.where(single, 0., dy) / numpy.where(single, 1., dx)
+        ya = numpy.where(single, ymin[element],
+                         y1[element] + (xa - x1[element]) * slope)
+        yb = numpy.where(single, ymax[element],
+                         y1[element] + (xb - x1[element]) * slope)
+
+        # Ends are widened a little against rounding, but kept within the
+        # bounding box of the segment
+        margin = size * 1e-9
+        lower = (numpy.maximum(numpy.minimum(ya, yb) - margin,
+                               ymin[element]) // size).astype(int)
+        upper = (numpy.minimum(numpy.maximum(ya, yb) + margin,
+                               ymax[element]) // size).astype(int)
+        part, offset = _spread(upper - lower + 1)
+        return element[part], slab[part], lower[part] + offset
+
+    def _add(self, primitive, element, cells_x, cells_y):
+        """
+        Records a primitive made of elements (lines, or a single poly),
+        adding element `element[i]` to grid cell (cells_x[i], cells_y[i])
+        """
+
+        index = len(self.primitives)
+        self.primitives.append(primitive)
+
+        order = numpy.lexsort((element, cells_y, cells_x))
+        cells_x, cells_y = cells_x[order], cells_y[order]
+        element = element[order]
+        starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], (cells_x[1:] != cells_x[:-1]) |
+                     (cells_y[1:] != cells_y[:-1]))))
+        for start, elements in zip(starts, numpy.split(element, starts[1:])):
+            self.grid[cells_x[start], cells_y[start]].append((index, elements))
+
+    def _visible(self, clip):
+        """
+        Returns the indexes of primitives overlapping given window, in the
+        order they were recorded, along with the indexes of their elements
+        which do
+        """
+
+        xmin, ymin, xmax, ymax = clip
+        xmin, xmax = sorted((xmin, xmax))
+        ymin, ymax = sorted((ymin, ymax))
+        xmin, xmax = xmin // self.cell_size, xmax // self.cell_size
+        ymin, ymax = ymin // self.cell_size, ymax // self.cell_size
+
+        if (xmax - xmin + 1) * (ymax - ymin + 1) < len(self.grid):
+            entries = [entry for cell_x in range(xmin, xmax + 1)
+                       for cell_y in range(ymin, ymax + 1)
+                       for entry in self.grid.get((cell_x, cell_y), ())]
+        else:
+            entries = [entry for (cell_x, cell_y), cell in self.grid.items()
+                       if xmin <= cell_x <= xmax and ymin <= cell_y <= ymax
+                       for entry in cell]
+
+        visible = defaultdict(list)
+        for index, elements in entries:
+            visible[index].append(elements)
+        return [(index, numpy.unique(numpy.concatenate(visible[index])))
+                for index in sorted(visible)]
+
+    def calls(self, image, clip=None):
+        """
+        Yields the XPM drawing calls, of the form (name, args, kwargs), that
+        draw the recorded primitives on image, optionally only the ones
+        overlapping a rectangle having its diagonal from (xmin, ymin) to
+        (xmax, ymax), clipped to it
+        Clipping happens in display list coordinates, before transforms
+        defined for the image are applied
+        """
+
+        if clip:
+            visible = self._visible(clip)
+        else:
+            visible = [(index, None) for index in range(len(self.primitives))]
+
+        for index, elements in visible:
+            kind, data, color, options = self.primitives[index]
+            if kind == 'lines':
+                segments = data if elements is None else data[elements]
+                if clip:
+                    if self.counters is not None:
+                        start, count = time.time(), len(segments)
+                        inside = int(((outcodes(segments[:, 0],
+                                                segments[:, 1], clip) |
+                                       outcodes(segments[:, 2],
+                                                segments[:, 3], clip)) ==
+                                      0).sum())
+                    segments = clip_lines(segments, clip)
+                    if self.counters is not None:
+                        self.counters['segments_rejected'] += \
+                            count - len(segments)
+                        self.counters['segments_clipped'] += \
+                            len(segments) - inside
+                        self.timings['clip'] += time.time() - start
+                segments = image.apply_transforms(
+                    segments.reshape(-1, 2)).reshape(-1, 4)
+                yield 'lines', (segments, color), {}
+            elif clip:
+                yield 'complex_poly', (data, color), dict(options, clip=clip)
+            else:
+                yield 'poly', (data, color), options
+
+    def render(self, image, clip=None):
+        """
+        Draws the recorded primitives on image, optionally only the ones
+        overlapping a rectangle having its diagonal from (xmin, ymin) to
+        (xmax, ymax), clipped to it (see `calls`)
+        """
+
+        for name, args, kwargs in self.calls(image, clip):
+            getattr(image, name)(*args, **kwargs)
+
+
+def _spread(counts):
+    """
+    Returns, for ranges of given lengths, the index of the range of each of
+    their items, and the offset of the item in its range
+    """
+
+    index = numpy.repeat(numpy.arange(len(counts)), counts)
+    offset = numpy.arange(counts.sum()) - \
+        numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return index, offset
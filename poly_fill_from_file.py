@@ -1,4 +1,7 @@
 import argparse
+import render_cache
+import sys
+from display_list import DisplayList
 from xpm import XPM, Color
 
 
@@ -15,7 +18,7 @@ parser.add_argument(
     type=int, help='Height of XPM image')
 parser.add_argument(
     '-o', '--output',
-    help='Output file (of XPM type)')
+    help='Output file (of XPM type, or PPM or PNG by its extension)')
 parser.add_argument(
     '-r', '--red',
     type=int, help='Red component of fill color')
@@ -49,8 +52,18 @@ parser.add_argument(
 parser.add_argument(
     '-vb', '--viewport-bottom',
     type=int, help='Bottom limit of viewport rectangle')
+parser.add_argument(
+    '--stats', action='store_true',
+    help='Print drawing counters and stage timings to standard error')
+render_cache.add_arguments(parser)
 args = parser.parse_args()
 
+# Images rendered before with the same input and options are not rendered
+# again
+cache_key = render_cache.key('poly_fill_from_file', args)
+if render_cache.fetch(args, cache_key):
+    sys.exit(0)
+
 # Vertices are stored one per line in a .pol file, with x and y coords
 # separated by a space
 vertices = [map(int, line.replace('\n', '').split())
@@ -72,11 +85,19 @@ x_factor = 1.*(args.viewport_bottom-args.viewport_top)/(args.window_bottom-args.
 y_factor = 1.*(args.viewport_right-args.viewport_left)/(args.window_right-args.window_left)
 
 image = XPM(args.width, args.height)
+scene = DisplayList()
+if args.stats:
+    image.instrument()
+    scene.instrument(shared=image)
+scene.poly(vertices=vertices, color=color, fill=color)
+
 image.scale(args.viewport_top, args.viewport_left, x_factor, y_factor)
-image.complex_poly(
-    vertices=vertices,
-    color=color,
-    fill=color,
+scene.render(
+    image,
     clip=(args.window_left, args.window_bottom,
           args.window_right, args.window_top) if clipping else None)
 image.export(args.output, autofill=True)
+render_cache.store(args, cache_key)
+
+if args.stats:
+    sys.stderr.write(image.report())
@@ -0,0 +1,183 @@
+import re
+from xpm import flatten_bezier
+
+
+# Procedures, names, numbers and operators of a (simplified) PostScript file
+TOKEN = re.compile(r'[{}]|[^\s{}%]+')
+
+
+def tokens(lines):
+    """
+    Yields the tokens of a PostScript file, line by line, skipping comments
+    """
+
+    for line in lines:
+        for token in TOKEN.findall(line.split('%', 1)[0]):
+            yield token
+
+
+def number(token):
+    """
+    Returns the number a token stands for, or None if it is no number
+    """
+
+    try:
+        return int(token)
+    except ValueError:
+        try:
+            return float(token)
+        except ValueError:
+            return None
+
+
+def primitives(tokens, height, tolerance=0.5):
+    """
+    Interprets the path operators of a PostScript program (moveto, rmoveto,
+    lineto, rlineto, curveto, closepath, newpath, stroke and fill), as well
+    as `x1 y1 x2 y2 Line` records, and yields the primitives they paint,
+    as soon as they are painted:
+    ('lines', [[x1, y1, x2, y2], ...]) for stroked lines,
+    ('bezier', [[x0, y0], ... [x3, y3]]) for stroked curves and
+    ('fill', [[[x1, y1], [x2, y2], ...], ...]) for filled paths, as the
+    vertices of each of their subpaths, with curves flattened to given
+    tolerance, to be filled together with the nonzero winding rule
+    Points are translated to the coordinate system used in xpm.py, given the
+    height of the image; PostScript has the origin in the lower-left corner
+    Procedure definitions are skipped and other operators are ignored
+    """
+
+    def point(x, y):
+        return [height - y, x]
+
+    stack = []
+    subpaths = []
+    current = None
+    depth = 0
+
+    for token in tokens:
+        # Skip procedures, such as the body of a `/Line {...} def`, which
+        # stand for a single (unknown) operand
+        if token == '{':
+            depth += 1
+            continue
+        elif token == '}':
+            depth -= 1
+            if not depth:
+                stack.append(None)
+            continue
+        elif depth:
+            continue
+
+        value = number(token)
+        if value is not None:
+            stack.append(value)
+            continue
+
+        if token in ('moveto', 'rmoveto'):
+            x, y = stack.pop(-2), stack.pop()
+            if token == 'rmoveto':
+                x, y = current[0] + x, current[1] + y
+            current = (x, y)
+            subpaths.append([('start', current)])
+        elif token in ('lineto', 'rlineto'):
+            x, y = stack.pop(-2), stack.pop()
+            if token == 'rlineto':
+                x, y = current[0] + x, current[1] + y
+            current = (x, y)
+            subpaths[-1].append(('line', current))
+        elif token == 'curveto':
+            coords = stack[-6:]
+            del stack[-6:]
+            controls = list(zip(coords[::2], coords[1::2]))
+            current = controls[-1]
+            subpaths[-1].append(('curve', controls))
+        elif token == 'closepath':
+            if subpaths and len(subpaths[-1]) > 1:
+                current = subpaths[-1][0][1]
+                subpaths[-1].append(('line', current))
+                subpaths.append([('start', current)])
+        elif token == 'newpath':
+            subpaths, current = [], None
+        elif token == 'stroke':
+            for primitive in _stroke(subpaths, point):
+                yield primitive
+            subpaths, current = [], None
+        elif token == 'fill':
+            contours = [[point(x, y) for x, y in vertices]
+                        for vertices in (_flatten(subpath, tolerance)
+                                         for subpath in subpaths)
+                        if len(vertices) > 2]
+            if contours:
+                yield 'fill', contours
+            subpaths, current = [], None
+        elif token == 'Line':
+            x1, y1, x2, y2 = stack[-4:]
+            del stack[-4:]
+            yield 'lines', [point(x1, y1) + point(x2, y2)]
+        elif token == 'def':
+            del stack[-2:]
+        elif token.startswith('/'):
+            # Literal names are operands, such as the key of a `def`
+            stack.append(token)
+        else:
+            # Operators outside of the path subset (bind, showpage...)
+            continue
+
+
+def _stroke(subpaths, point):
+    """
+    Yields the primitives stroking given subpaths
+    """
+
+    for subpath in subpaths:
+        segments = []
+        start = subpath[0][1]
+        for kind, value in subpath[1:]:
+            if kind == 'line':
+                segments.append(point(*start) + point(*value))
+                start = value
+            else:
+                if segments:
+                    yield 'lines', segments
+                    segments = []
+                yield 'bezier', [point(*start)] + [point(x, y)
+                                                    for x, y in value]
+                start = value[-1]
+        if segments:
+            yield 'lines', segments
+
+
+def _flatten(subpath, tolerance):
+    """
+    Returns the vertices of given subpath, with curves flattened
+    """
+
+    vertices = [subpath[0][1]]
+    for kind, value in subpath[1:]:
+        if kind == 'line':
+            vertices.append(value)
+        else:
+            vertices.extend(
+                flatten_bezier([vertices[-1]] + value, tolerance)[1:])
+    return vertices
+
+
+def batches(primitives, size=4096):
+    """
+    Groups primitives in lists painting about `size` elements (line
+    segments or vertices) each, merging consecutive line primitives
+    """
+
+    batch, count = [], 0
+    for kind, value in primitives:
+        if kind == 'lines' and batch and batch[-1][0] == 'lines':
+            batch[-1][1].extend(value)
+        else:
+            batch.append((kind, list(value)))
+        count += sum(map(len, value)) if kind == 'fill' else len(value)
+
+        if count >= size:
+            yield batch
+            batch, count = [], 0
+    if batch:
+        yield batch
@@ -1,6 +1,14 @@
 import argparse
+import postscript
+import render_cache
+import sys
+import tiles
+from display_list import DisplayList
 from xpm import XPM, Color
 
+# Number of line segments (or poly vertices) recorded before being drawn
+BATCH_SIZE = 4096
+
 # Define command line arguments and parse them
 parser = argparse.ArgumentParser(add_help=False)
 parser.add_argument(
@@ -8,7 +16,9 @@ parser.add_argument(
                     help='Input file (of simplified Postscript type)')
 parser.add_argument('-w', '--width', type=int, help='Width of XPM image')
 parser.add_argument('-h', '--height', type=int, help='Height of XPM image')
-parser.add_argument('-o', '--output', help='Output file (of XPM type)')
+parser.add_argument(
+    '-o', '--output',
+    help='Output file (of XPM type, or PPM or PNG by its extension)')
 parser.add_argument(
     '-wl', '--window-left', type=int,
                             help='Left limit of clipping rectangle')
@@ -24,43 +34,76 @@ parser.add_argument(
 parser.add_argument(
     '-t', '--transforms', type=argparse.FileType('r'),
     help='File containing transforms to be applied on input file')
+parser.add_argument(
+    '-j', '--processes', type=int,
+    help='Number of processes drawing tiles of the image in parallel')
+parser.add_argument(
+    '--mapped',
+    help='File keeping the pixels of the image, mapped in memory, for images '
+         'too large to fit in it')
+parser.add_argument(
+    '--tolerance', type=float, default=0.5,
+    help='Maximum distance (in pixels) between curves and the lines they are '
+         'drawn with')
+parser.add_argument(
+    '--stats', action='store_true',
+    help='Print drawing counters and stage timings to standard error')
+render_cache.add_arguments(parser)
 args = parser.parse_args()
+if args.mapped and args.processes:
+    parser.error('Tiles are drawn in memory; --mapped excludes -j')
+if args.tolerance <= 0:
+    parser.error('--tolerance must be positive')
 
-# Keep only valid lines from postscript file (the ones ending with LINE),
-# remove newline characters, split the valid lines to the 4 coordinates they
-# contain, and cast them to integers
-lines = [map(int, line.replace('Line\n', '').replace(' Line \n', '').split())
-         for line in list(args.file)
-         if line.endswith((' Line\n', ' Line \n'))]
-
-# Translate line points to the coordinate system used in xpm.py; postscript
-# files have the origin in the lower-left corner
-for line in lines:
-    line[0], line[1] = args.height - line[1], line[0]
-    line[2], line[3] = args.height - line[3], line[2]
+# Images rendered before with the same input and options are not rendered
+# again
+cache_key = render_cache.key('postscript_to_xpm', args)
+if render_cache.fetch(args, cache_key):
+    sys.exit(0)
 
-# Check whether lines need clipping
+# Check whether primitives need clipping
 clipping = (args.window_left and args.window_top and
             args.window_right and args.window_bottom)
+clip = (args.window_left, args.window_bottom,
+        args.window_right, args.window_top) if clipping else None
 
-image = XPM(args.width, args.height)
+image = XPM(args.width, args.height, compact=bool(args.processes),
+            mapped=args.mapped)
+color = Color('#FF0000', 'R')
 
-# Only perform transforms if transform file is given as input
+# Record primitives, transformed if a transform file is given as input, as
+# the input file is interpreted; without tiles, they are drawn one batch at a
+# time, so that the whole file is never held in memory
+scene = DisplayList()
+if args.stats:
+    image.instrument()
+    scene.instrument(shared=image)
 if args.transforms:
-    transforms = [line.split() for line in list(args.transforms)
-                  if line.startswith(('t', 'r', 's'))]
-    for t in transforms:
-        if t[0] == 't':
-            image.translate(*map(int, t[1:]))
-        elif t[0] == 'r':
-            image.rotate(*map(int, t[1:]))
-        elif t[0] == 's':
-            image.scale(*map(int, t[1:3])+map(float, t[3:5]))
+    scene.load_transforms(args.transforms)
+
+painted = postscript.primitives(postscript.tokens(args.file), args.height,
+                                args.tolerance)
+for batch in postscript.batches(painted, BATCH_SIZE):
+    for kind, value in batch:
+        if kind == 'lines':
+            scene.lines(value, color)
+        elif kind == 'bezier':
+            scene.bezier(value, None, color, tolerance=args.tolerance)
+        else:
+            # PostScript fills paths with the nonzero winding rule
+            scene.poly(value[0], color, fill=color, winding='nonzero',
+                       contours=value[1:])
 
-for line in lines:
-    image.complex_line(
-        *line,
-        clip=(args.window_left, args.window_bottom,
-              args.window_right, args.window_top) if clipping else None,
-        color=Color('#FF0000', 'R'))
+    # Only primitives within the clipping window, if any, are drawn
+    if not args.processes:
+        scene.render(image, clip)
+        scene.clear()
+
+if args.processes:
+    tiles.render(image, list(scene.calls(image, clip)),
+                 processes=args.processes)
 image.export(args.output, autofill=True)
+render_cache.store(args, cache_key)
+
+if args.stats:
+    sys.stderr.write(image.report())
@@ -0,0 +1,173 @@
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Where rendered images are cached, and how many bytes of them are kept
+CACHE_DIR = os.environ.get(
+    'XPM_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'graphical-elements'))
+CACHE_SIZE = 256 << 20
+
+# Size of the pieces input files are hashed in
+CHUNK_SIZE = 1 << 20
+
+# Options that do not change rendered images
+IGNORED = ('output', 'processes', 'mapped', 'stats',
+           'no_cache', 'cache_dir', 'cache_size', 'cache_link')
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments controlling the render cache to parser
+    """
+
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Render even if the same image was rendered before, and do not '
+             'cache it')
+    parser.add_argument(
+        '--cache-dir', default=CACHE_DIR,
+        help='Directory of cached images (defaults to %s)' % CACHE_DIR)
+    parser.add_argument(
+        '--cache-size', type=int, default=CACHE_SIZE,
+        help='Size of cached images (in bytes) above which least recently '
+             'used ones are evicted')
+    parser.add_argument(
+        '--cache-link', action='store_true',
+        help='Hard-link cached images to the output file instead of copying '
+             'them (the output must then not be edited in place)')
+
+
+def key(script, args):
+    """
+    Returns the key of the image rendered by script with given command line
+    arguments: a hash of the contents of the input files, the values of all
+    other options but the ones in IGNORED, the extension of the output file
+    and the code rendering it
+    Returns None if caching is off or if an input file can not be read
+    twice (such as standard input)
+    """
+
+    if args.no_cache or not args.output:
+        return None
+
+    digest = hashlib.sha256()
+    digest.update(script.encode('utf-8'))
+    digest.update(os.path.splitext(args.output)[1].lower().encode('utf-8'))
+
+    for name, value in sorted(vars(args).items()):
+        if name in IGNORED:
+            continue
+        digest.update(name.encode('utf-8'))
+        if hasattr(value, 'read'):
+            # Input files are hashed a piece at a time, so that they are never
+            # held in memory as a whole
+            contents = hashlib.sha256()
+            try:
+                position = value.tell()
+                for chunk in iter(lambda: value.read(CHUNK_SIZE),
+                                  value.read(0)):
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode('utf-8')
+                    contents.update(chunk)
+                value.seek(position)
+            except (IOError, OSError):
+                return None
+            digest.update(contents.digest())
+        else:
+            digest.update(repr(value).encode('utf-8'))
+
+    # Changing the code invalidates all cached images
+    for path in sorted(glob.glob(os.path.join(HERE, '*.py'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def fetch(args, key):
+    """
+    Copies (or hard-links) the image cached under key to the output file,
+    marking it as the most recently used, and returns whether it was cached
+    An output file hard-linked to a cached image by an earlier render is
+    removed otherwise, so that rendering to it never writes the cached image
+    """
+
+    if not _cached(args, key):
+        try:
+            if args.output and os.stat(args.output).st_nlink > 1:
+                os.remove(args.output)
+        except OSError:
+            pass
+        return False
+
+    path = os.path.join(args.cache_dir, key)
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    if args.cache_link:
+        try:
+            os.link(path, args.output)
+            return True
+        except OSError:
+            pass
+    shutil.copyfile(path, args.output)
+    return True
+
+
+def _cached(args, key):
+    """
+    Returns whether an image is cached under key, marking it as the most
+    recently used
+    """
+
+    if key is None:
+        return False
+    try:
+        os.utime(os.path.join(args.cache_dir, key), None)
+    except OSError:
+        return False
+    return True
+
+
+def store(args, key):
+    """
+    Caches the output file under key, then evicts least recently used images
+    until cached images take no more than the cache size
+    """
+
+    if key is None:
+        return
+
+    if not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+
+    # Images are written under a temporary name first, so that concurrent
+    # renders never fetch partly written images
+    handle, temporary = tempfile.mkstemp(dir=args.cache_dir, suffix='.tmp')
+    os.close(handle)
+    shutil.copyfile(args.output, temporary)
+    os.rename(temporary, os.path.join(args.cache_dir, key))
+
+    entries = []
+    for name in os.listdir(args.cache_dir):
+        if name.endswith('.tmp'):
+            continue
+        try:
+            stat = os.stat(os.path.join(args.cache_dir, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, name in sorted(entries):
+        if size <= args.cache_size:
+            break
+        try:
+            os.remove(os.path.join(args.cache_dir, name))
+        except OSError:
+            pass
+        size -= entry_size
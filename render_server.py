@@ -0,0 +1,238 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import batch
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+
+# Content types of rendered images, by output format
+CONTENT_TYPES = {
+    'xpm': 'image/x-xpixmap',
+    'ppm': 'image/x-portable-pixmap',
+    'png': 'image/png',
+}
+
+# Size of the pieces rendered images are streamed back in
+CHUNK_SIZE = 1 << 16
+
+# Options jobs may give scripts, all of which take a number, and the ones
+# taking a file, which must lie within the root of the server; other options
+# naming files (or processes) are left to whoever runs the server
+OPTIONS = ('-w', '-h', '-wl', '-wt', '-wr', '-wb', '-p', '-r', '-g', '-b',
+           '-vl', '-vt', '-vr', '-vb', '--tolerance')
+FILE_OPTIONS = ('-t',)
+
+# Types of input files jobs may give the contents of
+TYPES = ('ps', 'pol', 'bze')
+
+
+def validate(request, root=None):
+    """
+    Checks that a job (see `render`) only renders what the server allows,
+    raising ValueError otherwise: input files are given by their contents,
+    or by a path within `root` if one is set, and options are among OPTIONS,
+    each followed by a number, or among FILE_OPTIONS, each followed by a
+    path within `root`
+    """
+
+    if not isinstance(request, dict):
+        raise ValueError('A job must be a JSON object')
+
+    if 'path' in request:
+        request['path'] = _within(root, request['path'])
+    elif not isinstance(request.get('data'), type(u'')):
+        raise ValueError('A job must have the contents of its input file')
+    if request.get('type', 'ps') not in TYPES:
+        raise ValueError('Type must be one of %s' % ', '.join(TYPES))
+
+    script = request.get('script')
+    if script and script not in batch.INPUT_OPTIONS:
+        raise ValueError('Script must be one of %s' %
+                         ', '.join(sorted(batch.INPUT_OPTIONS)))
+
+    options = request.get('options', [])
+    if not isinstance(options, list) or len(options) % 2:
+        raise ValueError('Options must be a list of options and values')
+    checked = []
+    for option, value in zip(options[::2], options[1::2]):
+        if option in FILE_OPTIONS:
+            value = _within(root, value)
+        elif option in OPTIONS:
+            try:
+                float(value)
+            except (TypeError, ValueError):
+                raise ValueError('Option %s must be given a number' % option)
+        else:
+            raise ValueError('Options must be among %s' %
+                             ' '.join(OPTIONS + FILE_OPTIONS))
+        checked += [option, str(value)]
+    request['options'] = checked
+
+    if request.get('format', 'xpm') not in CONTENT_TYPES:
+        raise ValueError('Format must be one of %s' %
+                         ', '.join(sorted(CONTENT_TYPES)))
+
+
+def _within(root, path):
+    """
+    Returns the real path of a file given by a job, relative to `root`,
+    raising ValueError unless it lies within it
+    """
+
+    if not isinstance(path, type(u'')):
+        raise ValueError('A path must be a string')
+    if root is None:
+        raise ValueError('Files must be given by their contents')
+    path = os.path.realpath(os.path.join(root, path))
+    if not path.startswith(os.path.join(root, '')):
+        raise ValueError('Files must be within %s' % root)
+    return path
+
+
+def render(request):
+    """
+    Renders a job in a worker process, returning the path of the rendered
+    image and the error rendering failed with, if any
+    A job is a JSON object with either the contents of an input file
+    (`data`) along with its extension (`type`: 'ps', 'pol' or 'bze') or its
+    path (`path`, relative to the root of the server), the options of the
+    script rendering it (`options`), as given on its command line (with
+    transforms files relative to the root of the server too), and
+    optionally the script itself (`script`) and the output format
+    (`format`: 'xpm', 'ppm' or 'png'), checked by `validate`
+    Workers keep the modules the scripts use imported, so that interned
+    colors, Bezier bases and parsed transforms files stay cached
+    """
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = request.get('path')
+        if path is None:
+            path = os.path.join(directory,
+                                'input.%s' % request.get('type', 'ps'))
+            with open(path, 'w') as f:
+                f.write(request['data'])
+
+        output = os.path.join(directory,
+                              'output.%s' % request.get('format', 'xpm'))
+        arguments = ([request['script']] if request.get('script') else []) + \
+            [path, '-o', output]
+        _, script, arguments = batch.job(arguments,
+                                         request.get('options', []))
+        _, _, error = batch.render((path, script, arguments))
+    except (KeyError, TypeError, ValueError) as e:
+        error = 'Invalid job: %s' % e
+    if error:
+        shutil.rmtree(directory)
+        return None, error
+    return output, None
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        """
+        Renders the job posted (see `render`) with the worker pool, streaming
+        the rendered image back
+        """
+
+        # Requiring JSON keeps web pages from posting jobs without the
+        # browser asking the server first
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip().lower() != 'application/json':
+            return self.send_error(415, 'Jobs must be posted as JSON')
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            validate(request, self.server.root)
+        except (TypeError, ValueError) as e:
+            return self.send_error(400, str(e))
+
+        output, error = self.server.pool.apply(render, (request,))
+        if error:
+            return self.send_error(422, error)
+
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             CONTENT_TYPES[request.get('format', 'xpm')])
+            self.send_header('Content-Length', str(os.path.getsize(output)))
+            self.end_headers()
+            with open(output, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+        finally:
+            shutil.rmtree(os.path.dirname(output))
+
+    def address_string(self):
+        # Clients of Unix sockets have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+# Define command line arguments and parse them
+parser = argparse.ArgumentParser(
+    description='Renders jobs posted as JSON over HTTP, on localhost or on a '
+                'Unix socket, with a pool of warm worker processes')
+parser.add_argument(
+    '-p', '--port', type=int, default=8000,
+    help='Port listened to on localhost')
+parser.add_argument(
+    '-u', '--unix-socket',
+    help='Unix socket listened to instead of a port')
+parser.add_argument(
+    '-j', '--processes', type=int,
+    help='Number of worker processes (defaults to the number of CPUs)')
+parser.add_argument(
+    '-r', '--root',
+    help='Directory jobs may give the paths of input and transforms files '
+         'within (by default, jobs must give the contents of input files, '
+         'and can not use transforms files)')
+parser.add_argument(
+    '-q', '--quiet', action='store_true', help='Do not log requests')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, RenderHandler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), RenderHandler)
+    server.quiet = args.quiet
+    server.root = os.path.realpath(args.root) if args.root else None
+
+    # Requests are handled in threads, each waiting for a worker process
+    server.pool = multiprocessing.Pool(args.processes, batch._start_worker)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.close()
+        server.pool.join()
+        if args.unix_socket:
+            os.remove(args.unix_socket)
@@ -0,0 +1,62 @@
+import random
+import unittest
+from clipping import clip_lines, clip_polys
+
+
+def clip_line(x1, y1, x2, y2, clip):
+    """
+    Clips a single line the way `XPM.complex_line` does, with the integer
+    division of Python 2, returning None if it is rejected
+    """
+
+    xmin, ymin, xmax, ymax = clip
+
+    def outcode(x, y):
+        return ((1 if x < xmin else 2 if x > xmax else 0) |
+                (4 if y < ymin else 8 if y > ymax else 0))
+
+    code1, code2 = outcode(x1, y1), outcode(x2, y2)
+    while code1 | code2:
+        if code1 & code2:
+            return None
+        code = code1 or code2
+        if code & 8:
+            x, y = x1 + (x2-x1) * (ymax-y1) // (y2-y1), ymax
+        elif code & 4:
+            x, y = x1 + (x2-x1) * (ymin-y1) // (y2-y1), ymin
+        elif code & 2:
+            x, y = xmax, y1 + (y2-y1) * (xmax-x1) // (x2-x1)
+        else:
+            x, y = xmin, y1 + (y2-y1) * (xmin-x1) // (x2-x1)
+        if code == code1:
+            x1, y1 = x, y
+            code1 = outcode(x1, y1)
+        else:
+            x2, y2 = x, y
+            code2 = outcode(x2, y2)
+    return [x1, y1, x2, y2]
+
+
+class ClipLinesTest(unittest.TestCase):
+    def test_lines_are_clipped_as_by_complex_line(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            clip = sorted(rng.sample(range(-20, 120), 2))
+            clip = (clip[0], rng.randrange(-20, 50), clip[1],
+                    rng.randrange(50, 120))
+            segments = [[rng.randrange(-100, 200) for _ in range(4)]
+                        for _ in range(100)]
+            segments += [[10, 10, 10, 10], [clip[0], 0, clip[0], 200],
+                         [-50, clip[3], 300, clip[3]]]
+            expected = [clip_line(*segment + [clip])
+                        for segment in segments]
+            self.assertEqual(clip_lines(segments, clip).tolist(),
+                             [line for line in expected if line is not None])
+
+    def test_clip_requires_four_elements(self):
+        self.assertRaises(ValueError, clip_lines, [[0, 0, 1, 1]], (0, 0, 1))
+        self.assertRaises(ValueError, clip_polys, [[[0, 0], [1, 1]]], (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
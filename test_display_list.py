@@ -0,0 +1,63 @@
+import random
+import unittest
+import numpy
+from clipping import clip_lines
+from display_list import DisplayList
+from xpm import XPM, Color
+
+
+RED = Color('#FF0000', 'R')
+
+
+class GridTest(unittest.TestCase):
+    def test_clipped_calls_draw_all_visible_lines(self):
+        rng = random.Random(0)
+        scene, image = DisplayList(cell_size=16), XPM(10, 10)
+        for _ in range(50):
+            scene.lines([[rng.randrange(-50, 300) for _ in range(4)]
+                         for _ in range(rng.randrange(1, 20))], RED)
+        for _ in range(50):
+            clip = [rng.randrange(-20, 280) for _ in range(4)]
+            clip = (min(clip[0], clip[2]), min(clip[1], clip[3]),
+                    max(clip[0], clip[2]), max(clip[1], clip[3]))
+            drawn = [args[0].tolist()
+                     for _, args, _ in scene.calls(image, clip)]
+            expected = [clip_lines(segments, clip).tolist()
+                        for _, segments, _, _ in scene.primitives]
+            self.assertEqual([lines for lines in drawn if lines],
+                             [lines for lines in expected if lines])
+
+    def test_clipped_lines_are_counted(self):
+        rng = random.Random(1)
+        segments = [[rng.randrange(-50, 150) for _ in range(4)]
+                    for _ in range(100)]
+        clip = (10, 20, 90, 70)
+        scene, image = DisplayList(cell_size=16), XPM(100, 100)
+        scene.lines(segments, RED)
+        scene.instrument()
+        list(scene.calls(image, clip))
+
+        # Lines kept with an end outside of the window are clipped
+        clipped = [segment for segment in segments
+                   if len(clip_lines([segment], clip)) and not
+                   (10 <= segment[0] <= 90 and 10 <= segment[2] <= 90 and
+                    20 <= segment[1] <= 70 and 20 <= segment[3] <= 70)]
+        self.assertTrue(clipped)
+        self.assertEqual(scene.counters['segments_clipped'], len(clipped))
+
+    def test_lines_are_only_in_cells_they_touch(self):
+        scene = DisplayList(cell_size=10)
+        scene.line(0, 0, 99, 99, RED)
+        scene.line(5, 0, 5, 99, RED)
+        cells = dict((index, set()) for index in range(2))
+        for cell, entries in scene.grid.items():
+            for index, _ in entries:
+                cells[index].add(cell)
+        # The diagonal goes through the corners of cells
+        self.assertEqual(cells[0], set((i, j) for i in range(10)
+                                       for j in range(10) if abs(i - j) <= 1))
+        self.assertEqual(cells[1], set((0, j) for j in range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
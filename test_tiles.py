@@ -0,0 +1,86 @@
+import random
+import unittest
+import tiles
+from xpm import XPM, Color
+
+
+RED = Color('#FF0000', 'R')
+GREEN = Color('#00FF00', 'G')
+BLUE = Color('#0000FF', 'B')
+
+
+def draw(primitives, size=100, instrumented=False):
+    """
+    Returns two compact images of the given size, the primitives being drawn
+    directly on the first and by tiles on the second
+    """
+
+    direct, tiled = XPM(size, size, True), XPM(size, size, True)
+    if instrumented:
+        direct.instrument()
+        tiled.instrument()
+    for name, args, kwargs in primitives:
+        getattr(direct, name)(*args, **kwargs)
+    tiles.render(tiled, primitives, tile_size=32, processes=2)
+    return direct, tiled
+
+
+class RenderTest(unittest.TestCase):
+    def test_colors_never_drawn_are_dropped(self):
+        # The fill of a flat poly draws nothing
+        direct, tiled = draw([
+            ('line', (5, 5, 90, 5, RED), {}),
+            ('poly', ([[50, 10], [50, 60], [50, 30]], GREEN), {'fill': BLUE}),
+            ('set', (2, 2, GREEN), {})])
+        self.assertEqual(tiled.palette, direct.palette)
+        self.assertEqual(tiled.colors, direct.colors)
+        self.assertEqual(tiled.pixels.tolist(), direct.pixels.tolist())
+
+    def test_fill_polys_across_tile_borders(self):
+        # Vertices and edges lie on and around the borders of 32 x 32 tiles
+        rng = random.Random(0)
+        for _ in range(5):
+            polys = [[[rng.choice([0, 31, 32, 33, 63, 64, 99]) +
+                       rng.randrange(-2, 3),
+                       rng.choice([0, 31, 32, 33, 63, 64, 99]) +
+                       rng.randrange(-2, 3)]
+                      for _ in range(rng.choice([3, 4, 6]))]
+                     for _ in range(8)]
+            polys.append([[31, 31], [31, 64], [64, 64], [64, 31]])
+            fills = [rng.choice([RED, GREEN, BLUE]) for _ in polys]
+            for winding in ('evenodd', 'nonzero'):
+                direct, tiled = draw([('fill_polys', (polys, fills),
+                                       {'winding': winding})])
+                self.assertEqual(tiled.palette, direct.palette)
+                self.assertEqual(tiled.pixels.tolist(),
+                                 direct.pixels.tolist())
+
+    def test_fill_rect_and_blit_across_tile_borders(self):
+        sprite = XPM(10, 10, True)
+        sprite.fill_rect(0, 0, 9, 9, BLUE)
+        sprite.fill_rect(3, 3, 6, 6, GREEN)
+        listed = XPM(10, 10)
+        listed.fill_rect(2, 0, 7, 9, RED)
+        for x in (-5, 0, 22, 27, 31, 32, 60, 95):
+            for y in (-3, 28, 32, 63, 91):
+                direct, tiled = draw([
+                    ('fill_rect', (x, y, x + 40, y + 3, RED), {}),
+                    ('fill_rect', (y, x, y - 2, x - 7, GREEN), {}),
+                    ('blit', (sprite, x, y), {'transparent': GREEN}),
+                    ('blit', (listed, y, x), {})])
+                self.assertEqual(tiled.palette, direct.palette)
+                self.assertEqual(tiled.pixels.tolist(),
+                                 direct.pixels.tolist())
+
+    def test_worker_counters_are_merged(self):
+        direct, tiled = draw([
+            ('line', (5, 5, 90, 70, RED), {}),
+            ('fill_rect', (10, 10, 60, 80, GREEN), {}),
+            ('poly', ([[3, 3], [90, 20], [50, 95]], RED), {'fill': BLUE})],
+            instrumented=True)
+        self.assertEqual(tiled.counters['pixels_written'],
+                         direct.counters['pixels_written'])
+
+
+if __name__ == '__main__':
+    unittest.main()
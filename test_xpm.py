@@ -0,0 +1,172 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy
+import xpm
+from xpm import XPM, Color, UndefinedPixelError, bezier_curve, \
+    bezier_curves, flatten_bezier
+
+
+RED = Color('#FF0000', 'R')
+GREEN = Color('#00FF00', 'G')
+BLUE = Color('#0000FF', 'B')
+
+
+def colors(image):
+    """
+    Returns the colors of all pixels of an image, as lists of lines, so that
+    compact and list images (and images with palettes in different orders)
+    compare equal when they look the same
+    """
+
+    if image.compact:
+        return [[image.palette[index] for index in pixel_line]
+                for pixel_line in numpy.asarray(image.pixels).tolist()]
+    return [list(pixel_line) for pixel_line in image.pixels]
+
+
+class LinesTest(unittest.TestCase):
+    def test_lines_draw_as_line(self):
+        rng = random.Random(0)
+        for compact in (False, True):
+            for color in (RED, GREEN, BLUE):
+                segments = [[rng.randrange(-30, 30) for _ in range(4)]
+                            for _ in range(200)]
+                segments += [[5, 5, 5, 5], [0, 3, 29, 3], [3, 0, 3, 29]]
+                single, batched = XPM(30, 30, compact), XPM(30, 30, compact)
+                for segment in segments:
+                    single.line(*segment + [color])
+                batched.lines(segments, color)
+                self.assertEqual(colors(batched), colors(single))
+
+
+class FillPolysTest(unittest.TestCase):
+    def test_fill_polys_fills_as_fill(self):
+        rng = random.Random(0)
+        compact_pixels = xpm.COMPACT_PIXELS
+        try:
+            for trial in range(100):
+                # Compact spans are also painted in many small batches
+                xpm.COMPACT_PIXELS = 64 if trial % 2 else compact_pixels
+                size, compact = rng.choice([20, 60]), trial % 4 < 2
+                polys = [[[rng.randrange(-10, size + 10),
+                           rng.randrange(-10, size + 10)]
+                          for _ in range(rng.choice([3, 4, 5, 8]))]
+                         for _ in range(rng.randrange(1, 12))]
+                polys.append([[5, 5], [5, 15], [15, 15], [15, 5]])
+                fills = [rng.choice([RED, GREEN, BLUE]) for _ in polys]
+                winding = rng.choice(['evenodd', 'nonzero'])
+                single = XPM(size, size, compact)
+                batched = XPM(size, size, compact)
+                for vertices, fill in zip(polys, fills):
+                    single._fill([vertices], fill, winding == 'nonzero')
+                batched.fill_polys(polys, fills, winding)
+                self.assertEqual(colors(batched), colors(single))
+        finally:
+            xpm.COMPACT_PIXELS = compact_pixels
+
+
+class BeziersTest(unittest.TestCase):
+    def curves(self, rng, size, count):
+        return [[[rng.randrange(size), rng.randrange(size)]
+                 for _ in range(rng.choice([1, 2, 3, 4, 4, 6]))]
+                for _ in range(count)]
+
+    def test_batched_points_equal_single_curve_points(self):
+        rng = random.Random(0)
+        for step in (0.3, 0.1, 0.02):
+            curves = self.curves(rng, 200, 300)
+            points, index = bezier_curves(curves, step)
+            for i, curve in enumerate(curves):
+                self.assertEqual(points[index == i].tolist(),
+                                 bezier_curve(curve, step).tolist())
+
+    def test_degenerate_curves_stay_on_their_point(self):
+        self.assertEqual(bezier_curve([[5, 5]] * 3, 0.3).tolist(), [[5, 5]])
+        self.assertEqual(bezier_curve([[4, 2], [27, 12]], 0.3).tolist(),
+                         [[27, 12], [20, 9], [13, 6], [6, 3]])
+
+    def test_tolerance_must_be_positive(self):
+        for tolerance in (0, -1, float('nan')):
+            self.assertRaises(ValueError, flatten_bezier,
+                              [[0, 0], [5, 9], [9, 0]], tolerance)
+            self.assertRaises(ValueError, XPM(10, 10).bezier,
+                              [[0, 0], [5, 9], [9, 0]], None, RED,
+                              tolerance=tolerance)
+
+    def test_beziers_draw_as_bezier(self):
+        rng = random.Random(1)
+        for compact in (False, True):
+            for step, tolerance in ((0.01, None), (0.1, None), (None, 0.5)):
+                curves = self.curves(rng, 60, 40)
+                single, batched = XPM(60, 60, compact), XPM(60, 60, compact)
+                for curve in curves:
+                    single.bezier(curve, step, RED, tolerance=tolerance)
+                batched.beziers(curves, step, RED, tolerance=tolerance)
+                self.assertEqual(colors(batched), colors(single))
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_exports_leave_no_temporary_file(self):
+        image = XPM(4, 4)
+        image.set(0, 0, RED)
+        path = os.path.join(self.directory, 'image.png')
+        self.assertRaises(UndefinedPixelError, image.export, path)
+        image.set(1, 1, Color('None', 'n'))
+        image.autofill()
+        self.assertRaises(ValueError, image.export, path)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_incremental_exports_equal_full_exports(self):
+        rng = random.Random(0)
+        sprite = XPM(5, 5, True)
+        sprite.fill_rect(0, 0, 4, 4, BLUE)
+        path = os.path.join(self.directory, 'incremental.xpm')
+        for compact in (False, True):
+            incremental, full = XPM(40, 40, compact), XPM(40, 40, compact)
+            for image in (incremental, full):
+                image.fill_rect(0, 0, 39, 39, RED)
+            incremental.export(path, incremental=True)
+            for step in range(12):
+                kind = step % 6
+                if kind == 0:
+                    call = ('set', (rng.randrange(40), rng.randrange(40),
+                                    GREEN), {})
+                elif kind == 1:
+                    call = ('lines', ([[rng.randrange(40) for _ in range(4)]
+                                       for _ in range(5)], BLUE), {})
+                elif kind == 2:
+                    call = ('fill_rect', (rng.randrange(40), 3,
+                                          rng.randrange(40), 9, GREEN), {})
+                elif kind == 3:
+                    call = ('blit', (sprite, rng.randrange(-2, 38),
+                                     rng.randrange(-2, 38)), {})
+                elif kind == 4:
+                    call = ('fill_polys', ([[[rng.randrange(40),
+                                              rng.randrange(40)]
+                                             for _ in range(4)]], [RED]), {})
+                else:
+                    call = ('poly', ([[2, 2], [2, 30], [20, 16]],
+                                     Color('#%06X' % step, str(step % 10))),
+                            {'fill': GREEN})
+                for image in (incremental, full):
+                    getattr(image, call[0])(*call[1], **call[2])
+                if step == 7:
+                    # The file is rewritten if it changed since last export
+                    open(path, 'w').close()
+                incremental.export(path, incremental=True)
+                full.export(path + '.full')
+                with open(path) as f, open(path + '.full') as g:
+                    self.assertEqual(f.read(), g.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+import inspect
+import multiprocessing
+import numpy
+from xpm import XPM, Color
+
+
+# Typecodes of shared arrays holding compact pixels, by pixel type
+TYPECODES = {numpy.dtype(numpy.uint16): 'H', numpy.dtype(numpy.uint32): 'I'}
+
+
+class Tile(XPM):
+    def __init__(self, image, pixels, x1, y1, x2, y2):
+        """
+        Initializes a view of the compact image `image` whose pixels are
+        `pixels`, only pixels from (x1, y1) up to, but excluding, (x2, y2) of
+        which are written by drawing on it
+        Primitives are still rasterized as a whole, so that the pixels drawn
+        in the tile are the same as the ones drawn on the whole image
+        The colors of pixels written in the tile are kept (`self.drawn`), and
+        the tile counts what drawing does if the image does
+        """
+
+        self.width = image.width
+        self.height = image.height
+        self.compact = True
+        self.mapped = None
+        self.cpp = image.cpp
+        self.colors = image.colors
+        self.palette = image.palette
+        self.indexes = image.indexes
+        self.pixels = pixels
+        self.transforms = image.transforms
+        self.bounds = (x1, y1, x2, y2)
+        self._rows = None
+        self.drawn = set()
+        if image.counters is not None:
+            self.instrument()
+
+    def set(self, x, y, color):
+        if not (-self.height <= x < self.height and
+                -self.width <= y < self.width):
+            raise IndexError('Pixel outside of the image')
+        if x < 0:
+            x += self.height
+        if y < 0:
+            y += self.width
+
+        x1, y1, x2, y2 = self.bounds
+        if x1 <= x < x2 and y1 <= y < y2:
+            if self.counters is not None:
+                self.counters['pixels_written'] += 1
+            self.drawn.add(color)
+            self.pixels[x, y] = self._index(color)
+
+    def line(self, x1, y1, x2, y2, color):
+        self.lines([[x1, y1, x2, y2]], color)
+
+    def lines(self, segments, color):
+        # Only lines that may cross the tile (or wrap around the image) are
+        # rasterized
+        segments = numpy.asarray(segments, dtype=numpy.int64).reshape(-1, 4)
+        xs, ys = segments[:, ::2], segments[:, 1::2]
+        x1, y1, x2, y2 = self.bounds
+        crossing = ((xs.max(axis=1) >= x1) & (xs.min(axis=1) < x2) &
+                    (ys.max(axis=1) >= y1) & (ys.min(axis=1) < y2))
+        outside = ((segments < 0).any(axis=1) |
+                   (xs >= self.height).any(axis=1) |
+                   (ys >= self.width).any(axis=1))
+        XPM.lines(self, segments[crossing | outside], color)
+
+    def _set_pixels(self, xs, ys, color):
+        xs, ys = numpy.asarray(xs), numpy.asarray(ys)
+        if ((xs < -self.height) | (xs >= self.height) |
+                (ys < -self.width) | (ys >= self.width)).any():
+            raise IndexError('Pixel outside of the image')
+        xs = numpy.where(xs < 0, xs + self.height, xs)
+        ys = numpy.where(ys < 0, ys + self.width, ys)
+
+        x1, y1, x2, y2 = self.bounds
+        inside = (xs >= x1) & (xs < x2) & (ys >= y1) & (ys < y2)
+        if inside.any():
+            if self.counters is not None:
+                self.counters['pixels_written'] += int(inside.sum())
+            self.drawn.add(color)
+            self.pixels[xs[inside], ys[inside]] = self._index(color)
+
+    def _set_span(self, x, y1, y2, color):
+        tx1, ty1, tx2, ty2 = self.bounds
+        y1, y2 = max(y1, ty1, 0), min(y2, ty2 - 1, self.width - 1)
+        if tx1 <= x < tx2 and y1 <= y2:
+            self.drawn.add(color)
+            XPM._set_span(self, x, y1, y2, color)
+
+    def _paint_spans(self, xs, y1s, y2s, indexes):
+        tx1, ty1, tx2, ty2 = self.bounds
+        y1s, y2s = numpy.maximum(y1s, ty1), numpy.minimum(y2s, ty2 - 1)
+        inside = (xs >= tx1) & (xs < tx2) & (y1s <= y2s)
+        if inside.any():
+            self.drawn.update(self.palette[index] for index in
+                              numpy.unique(indexes[inside]).tolist())
+            XPM._paint_spans(self, xs[inside], y1s[inside], y2s[inside],
+                             indexes[inside])
+
+    def autofill(self, color=Color('#FFFFFF', '_')):
+        x1, y1, x2, y2 = self.bounds
+        unset = self.pixels[x1:x2, y1:y2] == 0
+        if unset.any():
+            if self.counters is not None:
+                self.counters['pixels_written'] += int(unset.sum())
+            self.drawn.add(color)
+            self.pixels[x1:x2, y1:y2][unset] = self._index(color)
+
+    def fill_rect(self, x1, y1, x2, y2, color):
+        tx1, ty1, tx2, ty2 = self.bounds
+        x1, x2 = sorted((x1, x2))
+        y1, y2 = sorted((y1, y2))
+        x1, y1 = max(x1, tx1), max(y1, ty1)
+        x2, y2 = min(x2, tx2 - 1), min(y2, ty2 - 1)
+        if x1 <= x2 and y1 <= y2:
+            self.drawn.add(color)
+            XPM.fill_rect(self, x1, y1, x2, y2, color)
+
+    def _blit_source(self, src, x, y, transparent=None):
+        # Only the part of the source over the tile is copied, and only the
+        # colors found in it
+        tx1, ty1, tx2, ty2 = self.bounds
+        x1, y1 = max(x, tx1), max(y, ty1)
+        x2, y2 = min(x + src.height, tx2), min(y + src.width, ty2)
+        if x1 >= x2 or y1 >= y2:
+            return None
+
+        part = XPM.__new__(XPM)
+        part.__dict__.update(src.__dict__)
+        part.height, part.width = x2 - x1, y2 - y1
+        if src.compact:
+            part.pixels = src.pixels[x1-x:x2-x, y1-y:y2-y]
+        else:
+            part.pixels = [pixel_line[y1-y:y2-y]
+                           for pixel_line in src.pixels[x1-x:x2-x]]
+        source = XPM._blit_source(self, part, x1, y1, transparent)
+        if source is not None:
+            self.drawn.update(source[-1])
+        return source
+
+
+def bounds(image, primitive):
+    """
+    Returns the rectangle (xmin, ymin, xmax, ymax) containing all pixels
+    drawing a primitive on image can set, or None if it can not be told
+    A primitive is a call of an XPM drawing method, of the form:
+    (name, args, kwargs), e.g. ('line', (1, 2, 30, 40, color), {})
+    """
+
+    name, args, kwargs = primitive
+    arguments = inspect.getcallargs(getattr(image, name), *args, **kwargs)
+
+    if name == 'set':
+        points = [[arguments['x'], arguments['y']]]
+    elif name in ('line', 'complex_line'):
+        points = [[arguments['x1'], arguments['y1']],
+                  [arguments['x2'], arguments['y2']]]
+    elif name == 'lines':
+        points = numpy.reshape(arguments['segments'], (-1, 2))
+    elif name in ('poly', 'complex_poly'):
+        points = [point for vertices in
+                  [arguments['vertices']] + list(arguments['contours'])
+                  for point in vertices]
+    elif name == 'bezier':
+        # A Bezier curve lies within the convex hull of its control points
+        points = arguments['points']
+    elif name == 'fill_polys':
+        points = [point for vertices in arguments['polys']
+                  for point in vertices]
+    elif name == 'fill_rect':
+        points = [[arguments['x1'], arguments['y1']],
+                  [arguments['x2'], arguments['y2']]]
+    elif name == 'blit':
+        src = arguments['src']
+        points = [[arguments['x'], arguments['y']],
+                  [arguments['x'] + src.height - 1,
+                   arguments['y'] + src.width - 1]]
+    else:
+        return None
+
+    if not len(points):
+        return None
+
+    transformed = name in ('complex_line', 'poly', 'complex_poly',
+                           'fill_polys') and \
+        arguments.get('transforms', True)
+    if transformed:
+        points = image.apply_transforms(points)
+    points = numpy.asarray(points).reshape(-1, 2)
+
+    xmin, ymin = points.min(axis=0)
+    xmax, ymax = points.max(axis=0)
+    if xmin < 0 or ymin < 0 or xmax >= image.height or ymax >= image.width:
+        # Negative indexes wrap around the image
+        return None
+    return int(xmin), int(ymin), int(xmax), int(ymax)
+
+
+def render(image, primitives, tile_size=256, processes=None):
+    """
+    Draws all primitives (see `bounds`) on the compact image `image`, in
+    order, splitting the image into tiles of `tile_size` x `tile_size` pixels
+    which are drawn by a pool of processes, into memory shared with them
+    Each tile is only given the primitives that may set pixels in it, and
+    the result is the same as drawing all primitives on the image directly;
+    so are the counters of the image, if it is instrumented, except for the
+    work repeated for primitives drawn in many tiles
+    """
+
+    if not image.compact:
+        raise ValueError('Only compact images can be rendered in tiles')
+
+    # All colors are added to the palette beforehand, in order of use, so
+    # that every process sees the same palette
+    first, cpp = len(image.palette), image.cpp
+    for name, args, kwargs in primitives:
+        arguments = inspect.getcallargs(getattr(image, name), *args, **kwargs)
+        if name == 'blit':
+            source = image._blit_source(arguments['src'], arguments['x'],
+                                        arguments['y'],
+                                        arguments['transparent'])
+            values = source[-1] if source else []
+        else:
+            # Default colors (such as autofill's) come last
+            values = list(args) + list(kwargs.values()) + \
+                list(arguments.values())
+        for value in values:
+            # fill_polys takes a list of colors
+            for color in (value if isinstance(value, list) else [value]):
+                if isinstance(color, Color):
+                    image._index(color)
+
+    tiles = [(x, y, min(x + tile_size, image.height),
+              min(y + tile_size, image.width))
+             for x in range(0, image.height, tile_size)
+             for y in range(0, image.width, tile_size)]
+    boxes = [bounds(image, primitive) for primitive in primitives]
+    tasks = [(tile, [i for i, box in enumerate(boxes)
+                     if box is None or (box[0] < tile[2] and
+                                        box[2] >= tile[0] and
+                                        box[1] < tile[3] and
+                                        box[3] >= tile[1])])
+             for tile in tiles]
+
+    shared = multiprocessing.RawArray(TYPECODES[image.pixels.dtype],
+                                      image.width * image.height)
+    pixels = numpy.frombuffer(shared, dtype=image.pixels.dtype).reshape(
+        image.height, image.width)
+    pixels[...] = image.pixels
+
+    # Workers get everything about the image but its pixels
+    shell = XPM.__new__(XPM)
+    shell.__dict__.update(image.__dict__)
+    shell.pixels = None
+
+    pool = multiprocessing.Pool(processes, _start_worker,
+                                (shell, shared, image.pixels.dtype,
+                                 primitives))
+    try:
+        results = pool.map(_render_tile, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    image.pixels[...] = pixels
+    _drop_colors(image, first, set().union(*[drawn for drawn, _ in results]),
+                 cpp)
+    image.touch()
+
+    if image.counters is not None:
+        for _, stats in results:
+            for name, value in stats['counters'].items():
+                image.counters[name] += value
+            for name, value in stats['timings'].items():
+                image.timings[name] += value
+
+
+def _drop_colors(image, first, drawn, cpp):
+    """
+    Drops the colors added to the palette of the image from index `first`
+    on which no tile drew, as drawing directly would never have added them,
+    renumbering the pixels of the others; `cpp` is the one of the image
+    before colors were added
+    """
+
+    unused = [color for color in image.palette[first:] if color not in drawn]
+    if not unused:
+        return
+
+    palette = image.palette[:first] + [color for color in image.palette[first:]
+                                       if color in drawn]
+    table = numpy.zeros(len(image.palette), dtype=image.pixels.dtype)
+    for index, color in enumerate(palette):
+        if color is not None:
+            table[image.indexes[color]] = index
+    image.pixels[...] = table[image.pixels]
+
+    # The set of colors is built again in order of use, as drawing directly
+    # would have, so that the color table is exported in the same order
+    for color in unused:
+        del image.indexes[color]
+    for index, color in enumerate(palette):
+        if color is not None:
+            image.indexes[color] = index
+    image.palette[:] = palette
+    image.colors.clear()
+    image.colors.update(palette[1:])
+    if not image.colors:
+        image.cpp = cpp
+
+
+def _start_worker(image, shared, dtype, primitives):
+    """
+    Keeps what every tile is drawn from in the worker process
+    """
+
+    global _image, _pixels, _primitives
+    _image = image
+    _pixels = numpy.frombuffer(shared, dtype=dtype).reshape(
+        image.height, image.width)
+    _primitives = primitives
+
+
+def _render_tile(task):
+    """
+    Draws the given primitives on a tile, in the worker process, returning
+    the colors of the pixels it wrote and its stats, if any
+    """
+
+    (x1, y1, x2, y2), indexes = task
+    tile = Tile(_image, _pixels, x1, y1, x2, y2)
+    for index in indexes:
+        name, args, kwargs = _primitives[index]
+        getattr(tile, name)(*args, **kwargs)
+    return tile.drawn, tile.stats()
@@ -1,6 +1,13 @@
-from math import pi, sin, cos
-import numpy
-from scipy.misc import comb
+import importlib
+import mmap
+import os
+import re
+import string
+import struct
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from math import factorial, floor, pi, sin, cos
 
 
 IMAGE = '/* XPM */\n' \
@@ -17,47 +24,550 @@ COLORS = '"{chars} c {code}"'
 
 PIXELS = '"{pixels}"'
 
+# Images with more pixels than this are stored compactly by default
+COMPACT_PIXELS = 1 << 20
+
+# Formats images can be exported to, by file extension
+FORMATS = ('xpm', 'ppm', 'png')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Size of the chunks of compressed pixels (IDAT) of PNG files
+PNG_CHUNK = 1 << 16
+
+
+class LazyModule(object):
+    """
+    Stands for a module which is only imported when first used, so that
+    code not needing it does not pay for importing it
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+# NumPy is only needed by vectorized features (compact images, lines,
+# Bezier curves, clipping...); drawing on small images does not import it
+numpy = LazyModule('numpy')
+
+# Characters handed out by `palette`; quotes and backslashes would need
+# escaping and '_' is used by `XPM.autofill`
+CHARS = (string.ascii_letters + string.digits +
+         ''.join(c for c in string.punctuation if c not in '"\\_'))
+
+# Any double-quoted string of an XPM file (values, colors or pixels)
+STRING = re.compile(b'"([^"]*)"')
+
+
+def _to_str(data):
+    """
+    Returns bytes read from a file as a native string
+    """
+
+    return data if isinstance(data, str) else data.decode('ascii')
+
+
+class UndefinedPixelError(Exception):
+    pass
+
+
+class Instrumented(object):
+    """
+    Optionally counts what drawing does (`self.counters`) and times each of
+    its stages (`self.timings`, in seconds); instrumented code only checks
+    whether `self.counters` is None when instrumentation is disabled
+    """
+
+    counters = None
+    timings = None
+
+    def instrument(self, enabled=True, shared=None):
+        """
+        Starts counting and timing from scratch or, if `enabled` is False,
+        stops doing so
+        If `shared` (another instrumented object) is given, its counters and
+        timings are added to instead
+        """
+
+        if not enabled:
+            self.counters = self.timings = None
+        elif shared is not None:
+            self.counters, self.timings = shared.counters, shared.timings
+        else:
+            self.counters, self.timings = defaultdict(int), defaultdict(float)
+
+    def stats(self):
+        """
+        Returns the counters and stage timings gathered since instrumentation
+        was enabled, or None if it is not
+        """
+
+        if self.counters is None:
+            return None
+        return {'counters': dict(self.counters),
+                'timings': dict(self.timings)}
+
+    def report(self):
+        """
+        Returns the stats as text, one counter or stage timing per line
+        """
+
+        stats = self.stats()
+        if stats is None:
+            return 'Instrumentation is disabled\n'
+        return ''.join(
+            ['%-24s %d\n' % item
+             for item in sorted(stats['counters'].items())] +
+            ['%-24s %.6fs\n' % item
+             for item in sorted(stats['timings'].items())])
+
 
 class Color(object):
-    def __init__(self, code, chars):
+    __slots__ = ('code', 'chars', '_hash')
+
+    # Colors are interned, by code and characters
+    _colors = {}
+
+    def __new__(cls, code, chars):
         """
-        Initializes a color object by setting the color code (in the format
-        '#RRGGBB') and the character representation of the color
+        Returns the color object having the given color code (in the format
+        '#RRGGBB') and character representation, creating it the first time
         """
 
-        self.code = code
-        self.chars = chars
+        try:
+            return cls._colors[code, chars]
+        except KeyError:
+            pass
+
+        color = super(Color, cls).__new__(cls)
+        color.code = code
+        color.chars = chars
+        color._hash = hash(color.__repr__())
+        cls._colors[code, chars] = color
+        return color
+
+    def __reduce__(self):
+        return Color, (self.code, self.chars)
 
     def __eq__(self, other):
         if isinstance(other, Color):
             return (self.code == other.code) and (self.chars == other.chars)
         return False
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __hash__(self):
-        return hash(self.__repr__())
+        return self._hash
 
     def __repr__(self):
         return '<%s for %s>' % (self.chars, self.code)
 
 
-class XPM(object):
-    def __init__(self, width, height):
+def palette(codes):
+    """
+    Returns a color object for each of given color codes, handing out
+    character representations of the shortest length that fits all of them
+    """
+
+    codes = list(codes)
+    cpp = 1
+    while len(CHARS) ** cpp < len(codes):
+        cpp += 1
+
+    colors = []
+    for index, code in enumerate(codes):
+        chars = ''
+        for _ in range(cpp):
+            index, char = divmod(index, len(CHARS))
+            chars = CHARS[char] + chars
+        colors.append(Color(code, chars))
+    return colors
+
+
+def round_away(value):
+    """
+    Returns value rounded to the nearest integer, halves away from zero, as
+    `round` does on Python 2 (Python 3 rounds them to even)
+    """
+
+    if value < 0:
+        return -int(floor(.5 - value))
+    return int(floor(value + .5))
+
+
+# Bernstein bases used by `XPM.bezier`, by degree and step, least recently
+# used first
+BASES = OrderedDict()
+BASES_SIZE = 64
+
+
+def binomial(n, k):
+    """
+    Returns the binomial coefficient of n, k
+    """
+
+    return factorial(n) // (factorial(k) * factorial(n-k))
+
+
+def bernstein_basis(degree, step):
+    """
+    Returns the (read-only) matrix of Bernstein polynomials of given degree,
+    sampled with given step, caching the most recently used ones
+    """
+
+    key = (degree, step)
+    try:
+        basis = BASES.pop(key)
+    except KeyError:
+        t = numpy.arange(0, 1, step)
+        basis = numpy.array([binomial(degree, k) * (t**(degree-k)) * (1-t)**k
+                             for k in range(degree+1)])
+        basis.flags.writeable = False
+        if len(BASES) >= BASES_SIZE:
+            BASES.popitem(last=False)
+    BASES[key] = basis
+    return basis
+
+
+def flatten_bezier(points, tolerance, depth=16):
+    """
+    Returns points along the Bezier curve having `points` as control points,
+    subdividing it in halves (de Casteljau) until the control points of each
+    piece are within `tolerance` of the line joining its ends, which must be
+    positive
+    """
+
+    if not tolerance > 0:
+        raise ValueError('Tolerance must be positive')
+
+    def flat(points):
+        (x1, y1), (x2, y2) = points[0], points[-1]
+        dx, dy = x2 - x1, y2 - y1
+        length = (dx*dx + dy*dy) ** .5
+        for x, y in points[1:-1]:
+            if length:
+                distance = abs(dx*(y1-y) - dy*(x1-x)) / length
+            else:
+                distance = ((x-x1)**2 + (y-y1)**2) ** .5
+            if distance > tolerance:
+                return False
+        return True
+
+    def subdivide(points, depth):
+        if depth == 0 or flat(points):
+            curve.append(points[-1])
+            return
+
+        # Each level of de Casteljau's construction gives a point of the
+        # left half and one of the right half
+        left, right = [points[0]], [points[-1]]
+        while len(points) > 1:
+            points = [((x1+x2)/2., (y1+y2)/2.)
+                      for (x1, y1), (x2, y2) in zip(points, points[1:])]
+            left.append(points[0])
+            right.append(points[-1])
+        subdivide(left, depth-1)
+        subdivide(right[::-1], depth-1)
+
+    points = [(float(x), float(y)) for x, y in points]
+    curve = [points[0]]
+    subdivide(points, depth)
+    return curve
+
+
+def bezier_curves(curves, step, tolerance=None):
+    """
+    Returns the points (converted to integers) of many Bezier curves, each
+    given by its control points and sampled or flattened as in
+    `bezier_curve`, as a single Nx2 array, along with the index of the curve
+    each point belongs to
+    Curves of the same degree are sampled together, against the Bernstein
+    basis they share
+    """
+
+    points, index = [], []
+    if tolerance is not None:
+        for i, controls in enumerate(curves):
+            curve = numpy.array(flatten_bezier(controls, tolerance))
+            points.append(curve.reshape(1, -1, 2))
+            index.append(numpy.array([i]))
+    else:
+        degrees = defaultdict(list)
+        for i, controls in enumerate(curves):
+            if len(controls):
+                degrees[len(controls)-1].append(i)
+        for degree, indexes in sorted(degrees.items()):
+            basis = bernstein_basis(degree, step)
+            controls = numpy.array([curves[i] for i in indexes], dtype=float)
+
+            # Products are summed one control point at a time, in the same
+            # order whatever the number of curves (a matrix product would
+            # round differently for a batch than for a single curve), and
+            # relative to the first control point, so that curves reaching
+            # their control points (or degenerate ones) do so exactly
+            origin = controls[:, 0, numpy.newaxis]
+            group = numpy.zeros((len(indexes), basis.shape[1], 2))
+            for k in range(1, degree + 1):
+                group += ((controls[:, k, numpy.newaxis] - origin) *
+                          basis[k][:, numpy.newaxis])
+            points.append(group + origin)
+            index.append(numpy.array(indexes))
+    if not points:
+        return numpy.zeros((0, 2), dtype=int), numpy.zeros(0, dtype=int)
+
+    curves_points, curves_index = [], []
+    for group, indexes in zip(points, index):
+        group = group.astype(int)
+
+        # Drop repeated points, so that no zero-length lines are drawn
+        keep = numpy.ones(group.shape[:2], dtype=bool)
+        keep[:, 1:] = (group[:, 1:] != group[:, :-1]).any(axis=2)
+        curves_points.append(group[keep])
+        curves_index.append(numpy.repeat(indexes, keep.sum(axis=1)))
+
+    points = numpy.concatenate(curves_points)
+    index = numpy.concatenate(curves_index)
+    if len(curves_index) > 1:
+        order = numpy.argsort(index, kind='mergesort')
+        points, index = points[order], index[order]
+    return points, index
+
+
+def bezier_curve(points, step, tolerance=None):
+    """
+    Returns the points (converted to integers) of the Bezier curve having
+    `points` as control points, sampled with given step or, if `tolerance` is
+    given, flattened to given tolerance, as an Nx2 array
+    """
+
+    return bezier_curves([points], step, tolerance)[0]
+
+
+# Number of lines joining the points of Bezier curves drawn at once
+BEZIER_BATCH = 1 << 16
+
+
+# Transforms parsed from transforms files, by path, size and modification time
+TRANSFORM_FILES = {}
+
+
+class Transformable(Instrumented):
+    """
+    Keeps a matrix (`self.transforms`) of transforms applied on points
+    """
+
+    def translate(self, x, y):
+        """
+        Creates a transform matrix for translating a point to (x, y)
+        """
+
+        self.transforms *= Matrix([[1, 0, x],
+                                   [0, 1, y],
+                                   [0, 0, 1]])
+
+    def rotate(self, x, y, angle):
+        """
+        Creates a transform matrix for rotating a point by given angle (in
+        degrees) around point (x, y)
+        It translates to/from the given point before/after rotation
+        """
+
+        radians = angle*pi/100
+
+        self.translate(x, y)
+        self.transforms *= Matrix([[cos(radians), -sin(radians), 0],
+                                   [sin(radians), cos(radians), 0],
+                                   [0, 0, 1]])
+        self.translate(-x, -y)
+
+    def scale(self, x, y, xfactor, yfactor):
+        """
+        Creates a transform matrix for scaling a point by given factors
+        around point (x, y)
+        It translates to/from the given point before/after scaling
+        """
+
+        self.translate(x, y)
+        self.transforms *= Matrix([[xfactor, 0, 0],
+                                   [0, yfactor, 0],
+                                   [0, 0, 1]])
+        self.translate(-x, -y)
+
+    def load_transforms(self, lines):
+        """
+        Adds the transforms listed in a transforms file (.tsf), one per line:
+        't x y' translates, 'r x y angle' rotates and
+        's x y xfactor yfactor' scales
+        The transforms of a file are kept once parsed, so that loading it
+        again, unchanged, does not parse it again
+        """
+
+        key = None
+        name = getattr(lines, 'name', None)
+        if isinstance(name, str) and os.path.isfile(name):
+            stat = os.stat(name)
+            key = (os.path.abspath(name), stat.st_size, stat.st_mtime)
+
+        transforms = TRANSFORM_FILES.get(key)
+        if transforms is None:
+            transforms = []
+            for line in lines:
+                t = line.split()
+                if not t:
+                    continue
+                if t[0] == 't':
+                    transforms.append(
+                        ('translate', [int(v) for v in t[1:3]]))
+                elif t[0] == 'r':
+                    transforms.append(('rotate', [int(v) for v in t[1:4]]))
+                elif t[0] == 's':
+                    transforms.append(
+                        ('scale', [int(v) for v in t[1:3]] +
+                                  [float(v) for v in t[3:5]]))
+            if key:
+                TRANSFORM_FILES[key] = transforms
+
+        for name, arguments in transforms:
+            getattr(self, name)(*arguments)
+
+    def _apply_transforms(self, x, y):
+        """
+        Applies transforms defined for image on point (x, y), returning the
+        new transformed point's coordinates, converted to integers
+        """
+
+        if self.counters is not None:
+            self.counters['points_transformed'] += 1
+
+        t = self.transforms
+        return (int(t[0][0]*x + t[0][1]*y + t[0][2]),
+                int(t[1][0]*x + t[1][1]*y + t[1][2]))
+
+    def apply_transforms(self, points):
+        """
+        Applies transforms defined for image on all given points at once,
+        returning the transformed points' coordinates, converted to integers
+        `points` must be of the form: [[x1, y1], [x2, y2], ...] (or an Nx2
+        array)
+        """
+
+        points = numpy.asarray(points).reshape(-1, 2)
+        if not self.transforms:
+            return points.astype(numpy.int64)
+
+        if self.counters is not None:
+            start = time.time()
+
+        t = numpy.array(self.transforms.elements)
+        x, y = points.T
+        points = numpy.column_stack((t[0, 0]*x + t[0, 1]*y + t[0, 2],
+                                     t[1, 0]*x + t[1, 1]*y + t[1, 2])
+                                    ).astype(numpy.int64)
+
+        if self.counters is not None:
+            self.counters['points_transformed'] += len(points)
+            self.timings['transform'] += time.time() - start
+        return points
+
+    def reset_transforms(self):
+        self.transforms = Matrix.identity(3)
+
+
+class XPM(Transformable):
+    def __init__(self, width, height, compact=None, mapped=None):
         """
         Initializes an XPM image with given width and height
+        If `compact` is set, pixels are stored as a NumPy array of indexes
+        into `self.palette` instead of a list of lists of Color objects,
+        which takes only a few bytes per pixel; by default, only images of
+        more than COMPACT_PIXELS pixels are
+        If `mapped` is a path, the image is compact and its indexes are kept
+        in a file there, mapped in memory, so that only the parts of it being
+        drawn or exported need to be in memory
         """
 
+        if mapped:
+            compact = True
+        elif compact is None:
+            compact = width * height > COMPACT_PIXELS
+
         self.width = width
         self.height = height
+        self.compact = compact
+        self.mapped = mapped
         self.cpp = None
         self.colors = set()
-        self.pixels = [[None for _ in range(width)] for _ in range(height)]
+        if compact:
+            # Index 0 is reserved for undefined pixels
+            self.palette = [None]
+            self.indexes = {}
+            if mapped:
+                self.pixels = numpy.memmap(mapped, dtype=numpy.uint16,
+                                           mode='w+', shape=(height, width))
+            else:
+                self.pixels = numpy.zeros((height, width), dtype=numpy.uint16)
+        else:
+            self.pixels = [[None for _ in range(width)] for _ in range(height)]
         self.transforms = Matrix.identity(3)
 
+        # Encoded pixel lines kept by incremental exports, the lines written
+        # since the last export, and what was exported where
+        self._rows = None
+        self._dirty = set()
+        self._exported = None
+
     def set(self, x, y, color):
         """
         Assign pixel (x,y) a color;
         """
 
+        if self.counters is not None:
+            self.counters['pixels_written'] += 1
+        if self._rows is not None:
+            self._dirty.add(x % self.height)
+
+        if self.compact:
+            self.pixels[x, y] = self._index(color)
+            return
+
+        self._check(color)
+        self.colors.add(color)
+        self.pixels[x][y] = color
+
+    def _set_pixels(self, xs, ys, color):
+        """
+        Assign all pixels (xs[i], ys[i]) the same color, checking the color
+        only once
+        """
+
+        if self.counters is not None:
+            self.counters['pixels_written'] += len(xs)
+        if self._rows is not None:
+            self._dirty.update(
+                numpy.unique(numpy.asarray(xs) % self.height).tolist())
+
+        if self.compact:
+            self.pixels[xs, ys] = self._index(color)
+            return
+
+        self._check(color)
+        self.colors.add(color)
+        pixels = self.pixels
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            pixels[x][y] = color
+
+    def _check(self, color):
+        """
+        Checks that color can be added to the image, setting the image's cpp
+        on the first color added
+        """
+
         if not isinstance(color, Color):
             raise TypeError('Supplied color must be a Color object')
 
@@ -68,52 +578,535 @@ class XPM(object):
                              'supplied color must match the one of colors '
                              'added to the image, which is %s' % self.cpp)
 
+    def _index(self, color):
+        """
+        Returns the palette index of given color, adding it to the palette
+        (and widening the pixel array, if needed) the first time it is used
+        """
+
+        try:
+            return self.indexes[color]
+        except KeyError:
+            pass
+
+        self._check(color)
+        index = len(self.palette)
+        if index > numpy.iinfo(self.pixels.dtype).max:
+            self._widen()
+
         self.colors.add(color)
-        self.pixels[x][y] = color
+        self.palette.append(color)
+        self.indexes[color] = index
+        return index
+
+    def _widen(self):
+        """
+        Widens palette indexes to 32 bits; mapped indexes are copied to a new
+        file a block of lines at a time, which then replaces the old one
+        """
+
+        if not self.mapped:
+            self.pixels = self.pixels.astype(numpy.uint32)
+            return
+
+        wider = numpy.memmap(self.mapped + '.tmp', dtype=numpy.uint32,
+                             mode='w+', shape=(self.height, self.width))
+        for block in self._blocks():
+            wider[block] = self.pixels[block]
+        wider.flush()
+        del wider
+        os.rename(self.mapped + '.tmp', self.mapped)
+        self.pixels = numpy.memmap(self.mapped, dtype=numpy.uint32,
+                                   mode='r+', shape=(self.height, self.width))
+
+    def _blocks(self):
+        """
+        Yields slices of lines of pixels, of about COMPACT_PIXELS pixels each
+        """
+
+        lines = max(1, COMPACT_PIXELS // max(1, self.width))
+        for x in range(0, self.height, lines):
+            yield slice(x, x + lines)
 
     def autofill(self, color=Color('#FFFFFF', '_')):
         """
         Fill unset pixels so that image can be exported
+        All unset pixels are found and filled at once, by masking the whole
+        image (compact images) or by rebuilding each line having any
         """
 
-        for x in range(self.height):
-            for y in range(self.width):
-                if not self.pixels[x][y]:
-                    self.set(x, y, color)
+        if self.counters is not None:
+            start = time.time()
+
+        if self.compact:
+            # A block of lines at a time, so that mapped images are not
+            # paged in (or copied) as a whole
+            for block in self._blocks():
+                unset = self.pixels[block] == 0
+                if not unset.any():
+                    continue
+                index = self._index(color)
+                self.pixels[block][unset] = index
+                if self.counters is not None:
+                    self.counters['pixels_written'] += int(unset.sum())
+                if self._rows is not None:
+                    self._dirty.update((block.start + numpy.flatnonzero(
+                        unset.any(axis=1))).tolist())
+        else:
+            for x, pixel_line in enumerate(self.pixels):
+                if None not in pixel_line:
+                    continue
+                self._check(color)
+                self.colors.add(color)
+                if self.counters is not None:
+                    self.counters['pixels_written'] += pixel_line.count(None)
+                if self._rows is not None:
+                    self._dirty.add(x)
+                pixel_line[:] = [color if pixel is None else pixel
+                                 for pixel in pixel_line]
+
+        if self.counters is not None:
+            self.timings['autofill'] += time.time() - start
+
+    def fill_rect(self, x1, y1, x2, y2, color):
+        """
+        Assign all pixels of the rectangle having its diagonal from (x1, y1)
+        to (x2, y2) a color, as a single slice (or a slice per line of a list
+        image); the rectangle is clipped to the image
+        """
+
+        x1, x2 = sorted((x1, x2))
+        y1, y2 = sorted((y1, y2))
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x2, self.height - 1), min(y2, self.width - 1)
+        if x1 > x2 or y1 > y2:
+            return
+
+        if not self.compact:
+            for x in range(x1, x2 + 1):
+                self._set_span(x, y1, y2, color)
+            return
+
+        if self.counters is not None:
+            self.counters['pixels_written'] += (x2 - x1 + 1) * (y2 - y1 + 1)
+        if self._rows is not None:
+            self._dirty.update(range(x1, x2 + 1))
+        self.pixels[x1:x2+1, y1:y2+1] = self._index(color)
+
+    def blit(self, src, x, y, transparent=None):
+        """
+        Copies the pixels of image `src` onto the image, with its top-left
+        pixel at (x, y), clipped to the image
+        Pixels of `src` which are unset, or of color `transparent`, are not
+        copied; colors of `src` are added to the image as they would by
+        drawing with them
+        """
 
-    def export(self, path, autofill=False):
+        source = self._blit_source(src, x, y, transparent)
+        if source is None:
+            return
+        x1, y1, x2, y2, region, colors = source
+        for color in colors:
+            self._check(color)
+        if not colors:
+            return
+
+        if self.compact:
+            # Source pixels are mapped to palette indexes of the image, 0
+            # standing for pixels left as they are
+            if src.compact:
+                table = numpy.zeros(len(src.palette), dtype=self.pixels.dtype)
+                for color in colors:
+                    table[src.indexes[color]] = self._index(color)
+                indexes = table[region]
+            else:
+                table = dict((color, self._index(color)) for color in colors)
+                indexes = numpy.array(
+                    [[table.get(pixel, 0) for pixel in pixel_line]
+                     for pixel_line in region], dtype=self.pixels.dtype)
+            copied = indexes != 0
+            target = self.pixels[x1:x2, y1:y2]
+            target[copied] = indexes[copied]
+            count = int(copied.sum())
+            rows = (x1 + numpy.flatnonzero(copied.any(axis=1))).tolist()
+        else:
+            if src.compact:
+                table = numpy.array([None] * len(src.palette), dtype=object)
+                for color in colors:
+                    table[src.indexes[color]] = color
+                region = table[region].tolist()
+            self.colors.update(colors)
+            count, rows = 0, []
+            for x, pixel_line in zip(range(x1, x2), region):
+                target = self.pixels[x]
+                copied = [pixel is not None and pixel != transparent
+                          for pixel in pixel_line]
+                if all(copied):
+                    target[y1:y2] = pixel_line
+                elif any(copied):
+                    target[y1:y2] = [
+                        pixel if keep else old for pixel, keep, old
+                        in zip(pixel_line, copied, target[y1:y2])]
+                else:
+                    continue
+                count += sum(copied)
+                rows.append(x)
+
+        if self.counters is not None:
+            self.counters['pixels_written'] += count
+        if self._rows is not None:
+            self._dirty.update(rows)
+
+    def _blit_source(self, src, x, y, transparent=None):
+        """
+        Returns the part of the image `src` blitting it at (x, y) copies (see
+        `blit`), as the rectangle (x1, y1, x2, y2) of the image it is copied
+        to, up to but excluding (x2, y2), the pixels of `src` over it and
+        the colors they copy, or None if it lies outside of the image
+        """
+
+        x1, y1 = max(x, 0), max(y, 0)
+        x2 = min(x + src.height, self.height)
+        y2 = min(y + src.width, self.width)
+        if x1 >= x2 or y1 >= y2:
+            return None
+
+        if src.compact:
+            region = src.pixels[x1-x:x2-x, y1-y:y2-y]
+            colors = [src.palette[index] for index in numpy.unique(region)
+                      if index]
+        else:
+            region = [pixel_line[y1-y:y2-y]
+                      for pixel_line in src.pixels[x1-x:x2-x]]
+            colors = set(pixel for pixel_line in region
+                         for pixel in pixel_line)
+            colors.discard(None)
+        colors = [color for color in colors if color != transparent]
+        return x1, y1, x2, y2, region, colors
+
+    def touch(self, rows=None):
+        """
+        Marks given lines of pixels (all of them by default) as written since
+        the last export, for pixels not written by drawing methods
+        """
+
+        if self._rows is not None:
+            self._dirty.update(range(self.height) if rows is None else
+                               [x % self.height for x in rows])
+
+    def export(self, path, autofill=False, incremental=False, format=None):
         """
         Export image to path.xpm file
+        Pixel lines are encoded and written one at a time, so exporting needs
+        no more memory than a single encoded line
+        If `incremental` is set, encoded lines are kept instead, and the lines
+        pixels are written to are tracked from then on, so that exporting
+        again only encodes those lines; if the colors did not change and
+        the file was left as exported, only those lines are rewritten in it
+        `format` is one of FORMATS: 'xpm', or binary 'ppm' (P6) or 'png'
+        (RGB), which is told by the extension of path by default
         """
 
+        if format is None:
+            format = os.path.splitext(path)[1][1:].lower()
+            if format not in FORMATS:
+                format = 'xpm'
+        elif format not in FORMATS:
+            raise ValueError('Format must be one of %s' % ', '.join(FORMATS))
+
         if autofill:
             self.autofill()
 
-        for x in self.pixels:
-            if None in x:
-                raise Exception('Cannot export image with undefined pixels')
+        if self.counters is not None:
+            start = time.time()
+
+        # Files are written under a temporary name and renamed into place
+        # once complete, so that a failed export leaves the file at path as
+        # it was, and no temporary file behind
+        temporary = path + '.tmp'
+
+        if format != 'xpm':
+            try:
+                with open(temporary, 'wb') as f:
+                    if format == 'ppm':
+                        self._write_ppm(f)
+                    else:
+                        self._write_png(f)
+                os.rename(temporary, path)
+            except:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+
+            if self.counters is not None:
+                self.timings['export'] += time.time() - start
+            return
 
+        header, footer = IMAGE.split('{pixels}')
         colors = ",\n".join(
             [COLORS.format(chars=color.chars,
                            code=color.code) for color in self.colors])
-        pixels = ",\n".join(
-            [PIXELS.format(pixels="".join(
-                [c.chars for c in pixel_line])) for pixel_line in self.pixels])
-        image = IMAGE.format(width=self.width,
-                             height=self.height,
-                             nof_colors=len(self.colors),
-                             cpp=self.cpp,
-                             colors=colors,
-                             pixels=pixels)
-
-        with open(path, 'w') as f:
-            f.write(image)
+        header = header.format(width=self.width,
+                               height=self.height,
+                               nof_colors=len(self.colors),
+                               cpp=self.cpp,
+                               colors=colors)
+        footer = footer.format()
+
+        if self._rows is None:
+            rows = self._encode_rows()
+            if incremental:
+                self._rows = []
+                rows = self._keep_rows(rows)
+        else:
+            # Dirty lines are all encoded before the file is touched
+            dirty = sorted(self._dirty)
+            encoded = list(self._encode_rows(dirty))
+            for x, row in zip(dirty, encoded):
+                self._rows[x] = row
+            rows = self._rows
+
+            if self._exported == self._state(path, header, footer):
+                with open(path, 'r+b') as f:
+                    row_size = len(rows[0]) + 2
+                    for x, row in zip(dirty, encoded):
+                        f.seek(len(header) + x * row_size)
+                        f.write(row.encode('ascii'))
+                rows = None
+
+        if rows is not None:
+            try:
+                with open(temporary, 'w') as f:
+                    f.write(header)
+                    f.writelines(self._separate(rows))
+                    f.write(footer)
+                os.rename(temporary, path)
+            except:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                if self._rows is not None and len(self._rows) < self.height:
+                    self._rows = None
+                raise
+
+        if self._rows is not None:
+            self._dirty.clear()
+            self._exported = self._state(path, header, footer)
+
+        if self.counters is not None:
+            self.timings['export'] += time.time() - start
+
+    def _state(self, path, header, footer):
+        """
+        Returns what tells whether the file at path is still the one last
+        exported by an incremental export, given its header and footer
+        (its size, in case it was written with other line endings)
+        """
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        size = (len(header) + len(footer) +
+                self.height * (len(self._rows[0]) + 2) - 2)
+        if stat.st_size != size:
+            return None
+        return os.path.abspath(path), header, footer, stat.st_mtime
+
+    def _keep_rows(self, rows):
+        """
+        Yields encoded lines of pixels, keeping them for incremental exports
+        """
+
+        for row in rows:
+            self._rows.append(row)
+            yield row
+
+    def _separate(self, rows):
+        """
+        Yields encoded lines of pixels, comma separated
+        """
+
+        separator = ''
+        for row in rows:
+            yield separator + row
+            separator = ',\n'
+
+    def _write_ppm(self, f):
+        """
+        Writes the image as a binary PPM (P6) file
+        """
+
+        f.write(('P6\n%d %d\n255\n' % (self.width, self.height)
+                 ).encode('ascii'))
+        for row in self._rgb_rows():
+            f.write(row)
+
+    def _write_png(self, f):
+        """
+        Writes the image as an 8-bit RGB PNG file, compressing lines of pixels
+        as they come and writing compressed data in chunks of PNG_CHUNK bytes
+        """
+
+        def chunk(kind, data):
+            f.write(struct.pack('>I', len(data)))
+            f.write(kind + data)
+            f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+        f.write(PNG_SIGNATURE)
+        chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height,
+                                   8, 2, 0, 0, 0))
+
+        compressor = zlib.compressobj()
+        pending = []
+        size = 0
+        for row in self._rgb_rows():
+            # Each line starts with its filter type, none
+            data = compressor.compress(b'\x00' + row)
+            if data:
+                pending.append(data)
+                size += len(data)
+            if size >= PNG_CHUNK:
+                chunk(b'IDAT', b''.join(pending))
+                pending, size = [], 0
+        pending.append(compressor.flush())
+        chunk(b'IDAT', b''.join(pending))
+        chunk(b'IEND', b'')
+
+    def _rgb_rows(self):
+        """
+        Yields each line of pixels as RGB bytes, looking colors up in a table
+        of their RGB values built once, raising an error as soon as an
+        undefined pixel is found
+        """
+
+        def rgb(color):
+            code = color.code.lstrip('#')
+            try:
+                return [int(code[i:i+2], 16) for i in (0, 2, 4)]
+            except ValueError:
+                raise ValueError('Color %s has no RGB value' % color.code)
+
+        if self.compact:
+            table = numpy.zeros((len(self.palette), 3), dtype=numpy.uint8)
+            for index, color in enumerate(self.palette[1:], 1):
+                table[index] = rgb(color)
+        else:
+            table = dict((color, struct.pack('BBB', *rgb(color)))
+                         for color in self.colors)
+
+        for pixel_line in self.pixels:
+            if self.compact:
+                if not pixel_line.all():
+                    raise UndefinedPixelError(
+                        'Cannot export image with undefined pixels')
+                yield table[pixel_line].tobytes()
+            else:
+                if None in pixel_line:
+                    raise UndefinedPixelError(
+                        'Cannot export image with undefined pixels')
+                yield b''.join([table[color] for color in pixel_line])
+
+    def _encode_rows(self, rows=None):
+        """
+        Yields the XPM representation of given lines of pixels (all of them
+        by default), raising an error as soon as an undefined pixel is found
+        """
+
+        if self.compact:
+            # Look up each palette entry's characters once, by index
+            chars = numpy.array([''] + [c.chars for c in self.palette[1:]],
+                                dtype=object)
+
+        for x in range(self.height) if rows is None else rows:
+            pixel_line = self.pixels[x]
+            if self.compact:
+                if not pixel_line.all():
+                    raise UndefinedPixelError(
+                        'Cannot export image with undefined pixels')
+                pixel_chars = chars[pixel_line].tolist()
+            else:
+                if None in pixel_line:
+                    raise UndefinedPixelError(
+                        'Cannot export image with undefined pixels')
+                pixel_chars = [c.chars for c in pixel_line]
+
+            yield PIXELS.format(pixels="".join(pixel_chars))
+
+    @classmethod
+    def load(cls, path, compact=None):
+        """
+        Loads an XPM image from path.xpm file, so that it can be edited and
+        exported again
+        The file is memory-mapped and each pixel line is decoded as a whole,
+        by looking up its characters (cpp at a time) in the color table
+        """
+
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            strings = (_to_str(s.group(1)) for s in STRING.finditer(data))
+
+            try:
+                width, height, nof_colors, cpp = [
+                    int(value) for value in next(strings).split()[:4]]
+                colors = []
+                for _ in range(nof_colors):
+                    entry = next(strings)
+                    keys = entry[cpp:].split()
+                    colors.append(Color(keys[keys.index('c') + 1],
+                                        entry[:cpp]))
+            except (StopIteration, ValueError, IndexError):
+                raise ValueError('Invalid XPM header in %s' % path)
+
+            # Pixel characters are matched against the color table in bulk,
+            # as fixed-width strings of cpp characters
+            chars = numpy.array([c.chars.encode('ascii') for c in colors],
+                                dtype='S%d' % cpp)
+            order = numpy.argsort(chars)
+            sorted_chars = chars[order]
+
+            indexes = numpy.empty((height, width), dtype=numpy.uint32)
+            for x in range(height):
+                try:
+                    pixel_line = numpy.frombuffer(
+                        next(strings).encode('ascii'), dtype=chars.dtype)
+                except StopIteration:
+                    raise ValueError('Missing pixel lines in %s' % path)
+                if len(pixel_line) != width:
+                    raise ValueError('Invalid length of pixel line %s in %s'
+                                     % (x, path))
+
+                positions = numpy.searchsorted(sorted_chars, pixel_line)
+                positions[positions == len(sorted_chars)] = 0
+                if not (sorted_chars[positions] == pixel_line).all():
+                    raise ValueError('Undefined color in pixel line %s in %s'
+                                     % (x, path))
+                indexes[x] = order[positions]
+        finally:
+            data.close()
+
+        image = cls(width, height, compact=compact)
+        image.cpp = cpp
+        image.colors = set(colors)
+        if image.compact:
+            image.palette = [None] + colors
+            image.indexes = dict((color, index + 1)
+                                 for index, color in enumerate(colors))
+            dtype = numpy.uint16 if len(colors) < 2**16 else numpy.uint32
+            image.pixels = (indexes + 1).astype(dtype)
+        else:
+            image.pixels = numpy.array(colors, dtype=object)[indexes].tolist()
+        return image
 
     def line(self, x1, y1, x2, y2, color):
         """
         Draws a colored line from (x1, y1) to (x2, y2)
         """
 
+        if self.counters is not None:
+            start = time.time()
+
         dx = abs(x2 - x1)
         dy = abs(y2 - y1)
 
@@ -139,6 +1132,53 @@ class XPM(object):
                 error += dx
                 y += sy
 
+        if self.counters is not None:
+            self.timings['rasterize'] += time.time() - start
+
+    def lines(self, segments, color):
+        """
+        Draws many colored lines at once, producing the same pixels as calling
+        `line` for each of them
+        `segments` must be of the form: [[x1, y1, x2, y2], ...] (or an Nx4
+        array)
+        """
+
+        segments = numpy.asarray(segments, dtype=numpy.int64).reshape(-1, 4)
+        if not len(segments):
+            return
+
+        if self.counters is not None:
+            start = time.time()
+
+        x1, y1, x2, y2 = segments.T
+        dx = numpy.abs(x2 - x1)
+        dy = numpy.abs(y2 - y1)
+        sx = numpy.where(x1 < x2, 1, -1)
+        sy = numpy.where(y1 < y2, 1, -1)
+
+        # Bresenham steps once per pixel along the major axis; the offset
+        # along the minor axis after m steps is ceil((2*minor*m - major) /
+        # (2*major)), which is exactly where the error term makes it step
+        major = numpy.maximum(numpy.maximum(dx, dy), 1)
+        counts = numpy.maximum(dx, dy) + 1
+        starts = numpy.cumsum(counts) - counts
+        segment = numpy.repeat(numpy.arange(len(segments)), counts)
+        m = numpy.arange(counts.sum()) - starts[segment]
+
+        x_major = (dx >= dy)[segment]
+        major = major[segment]
+        minor_steps = -((major - 2 * numpy.where(x_major, dy[segment],
+                                                 dx[segment]) * m)
+                        // (2 * major))
+        x_steps = numpy.where(x_major, m, minor_steps)
+        y_steps = numpy.where(x_major, minor_steps, m)
+
+        self._set_pixels(x1[segment] + sx[segment] * x_steps,
+                         y1[segment] + sy[segment] * y_steps, color)
+
+        if self.counters is not None:
+            self.timings['rasterize'] += time.time() - start
+
     def complex_line(self, x1, y1, x2, y2, color, clip=None, transforms=True):
         """
         Draws a colored line from (x1, y1) to (x2, y2), optionally clipping it
@@ -164,8 +1204,12 @@ class XPM(object):
             return outcode
 
         if transforms and self.transforms:
+            if self.counters is not None:
+                start = time.time()
             x1, y1 = self._apply_transforms(x1, y1)
             x2, y2 = self._apply_transforms(x2, y2)
+            if self.counters is not None:
+                self.timings['transform'] += time.time() - start
 
         if not clip:
             return self.line(x1, y1, x2, y2, color)
@@ -176,14 +1220,27 @@ class XPM(object):
         except ValueError:
             raise ValueError('Clip argument requires 4 elements')
 
+        if self.counters is not None:
+            start = time.time()
+            clipped = False
+
         outcode1 = compute_outcode(x1, y1)
         outcode2 = compute_outcode(x2, y2)
         while(True):
             if outcode1 | outcode2 == 0:
+                if self.counters is not None:
+                    self.counters['segments_clipped'] += clipped
+                    self.timings['clip'] += time.time() - start
                 return self.line(x1, y1, x2, y2, color)
             elif outcode1 & outcode2 != 0:
+                if self.counters is not None:
+                    self.counters['segments_rejected'] += 1
+                    self.timings['clip'] += time.time() - start
                 return None
 
+            if self.counters is not None:
+                clipped = True
+
             outcodeout = outcode1 or outcode2
             if outcodeout & 8:
                 x, y = x1 + (x2-x1) * (ymax-y1) / (y2-y1), ymax
@@ -202,193 +1259,450 @@ class XPM(object):
                 outcode2 = compute_outcode(x2, y2)
         return self.line(x1, y1, x2, y2, color)
 
-    def poly(self, vertices, color, fill=None):
+    def poly(self, vertices, color, fill=None, winding='evenodd',
+             contours=()):
         """
         Draws a colored poly with lines computed from given vertices,
-        optionally filling it with given color
+        optionally filling it with given color, using either the 'evenodd' or
+        the 'nonzero' winding rule
+        `contours` are further contours of the poly (such as the outline of
+        a hole), of the same form as `vertices`, drawn and filled along with
+        it, so that the winding rule applies to all contours at once
         `vertices` must be of the form: [[x1, y1], [x2, y2], ...]
         """
 
-        def intersection(line):
-            """
-            Returns a list of points which represent the intersection points
-            of any poly edge with the given horizontal line (`line`=x), sorted
-            by y value
-            """
-
-            points = []
-            for edge in edges:
-                x1, y1 = edge[0]
-                x2, y2 = edge[1]
-                if ((x1<=line and x2>=line or x2<=line and x1>=line) and x1!=x2):
-                    y = 1.*(line-x1)*(y2-y1)/(x2-x1)+y1
-                    if not [line, y] in points:
-                        points.append([line, int(round(y))])
-            return sorted(points, key=lambda p: p[1])
+        if winding not in ('evenodd', 'nonzero'):
+            raise ValueError('Winding rule must be either evenodd or nonzero')
 
-        edges = zip(vertices, vertices[1:]+[vertices[0]])
+        contours = [list(vertices)] + [list(contour) for contour in contours]
+        for contour in contours:
+            edges = zip(contour, contour[1:]+contour[:1])
 
-        for vertex1, vertex2 in edges:
-            x1, y1 = vertex1
-            x2, y2 = vertex2
-            self.complex_line(x1, y1, x2, y2, color)
+            for vertex1, vertex2 in edges:
+                x1, y1 = vertex1
+                x2, y2 = vertex2
+                self.complex_line(x1, y1, x2, y2, color)
 
         if not fill:
             return
 
-        # Start filling the poly...
-        xmin = min([v[0] for v in vertices])
-        xmax = max([v[0] for v in vertices])
-
-        for line in range(xmin, xmax+1):
-            points = intersection(line)
-
-            for p1, p2 in zip(points[::2], points[1::2]):
-                x1, y1 = p1
-                x2, y2 = p2
-                self.complex_line(x1, y1, x2, y2, fill)
+        # Fill in image coordinates, so that spans stay horizontal
+        if self.transforms:
+            contours = [[self._apply_transforms(x, y) for x, y in contour]
+                        for contour in contours]
+        self._fill(contours, fill, winding == 'nonzero')
 
-    def complex_poly(self, vertices, color, fill=None, clip=None):
+    def _fill(self, contours, color, nonzero=False):
         """
-        Draws a colored poly with lines computed from given vertices,
-        optionally clipping it to a rectangle having its diagonal from
-        (xmin, ymin) to (xmax, ymax) and optionally filling it with given color
-        `vertices` must be of the form: [[x1, y1], [x2, y2], ...]
+        Fills the poly with given contours (lists of vertices) by scanning it
+        line by line (`x`), keeping only the edges crossing the current line
+        active
+        Each edge covers lines from its top end up to, but excluding, its
+        bottom end, so that shared vertices are crossed once; lines through
+        vertices are also filled with edges covering lines from after their
+        top end up to their bottom end, so that top and bottom lines are
+        filled alike, and single vertices at the top or bottom are left to
+        the outline
         """
 
-        def inside(point):
-            return (
-                (clip_vertex2[0]-clip_vertex1[0])*(point[1]-clip_vertex1[1]) >
-                (clip_vertex2[1]-clip_vertex1[1])*(point[0]-clip_vertex1[0])
-            )
+        def fill(edges, end):
+            # Spans joining crossings at the same vertex, where edges meet
+            # at the top or bottom of the poly, are not filled
+            crossings = []
+            for edge in edges:
+                _, _, x1, y1, x2, y2, direction = edge
+                crossings.append((round_away(1.*(line-x1)*(y2-y1)/(x2-x1)+y1),
+                                  direction, edge[end] == line))
+            crossings.sort()
+
+            if nonzero:
+                count = 0
+                for (y1, direction, vertex1), (y2, _, vertex2) in zip(
+                        crossings, crossings[1:]):
+                    count += direction
+                    if count and not (y1 == y2 and vertex1 and vertex2):
+                        self._set_span(line, y1, y2, color)
+            else:
+                for (y1, _, vertex1), (y2, _, vertex2) in zip(
+                        crossings[::2], crossings[1::2]):
+                    if not (y1 == y2 and vertex1 and vertex2):
+                        self._set_span(line, y1, y2, color)
+
+        # Edge table, sorted by top end; horizontal edges never cross a line
+        edge_table = sorted(
+            (min(x1, x2), max(x1, x2), x1, y1, x2, y2, 1 if x2 > x1 else -1)
+            for vertices in contours
+            for (x1, y1), (x2, y2) in zip(vertices, vertices[1:]+vertices[:1])
+            if x1 != x2)
+        if not edge_table:
+            return
 
-        def intersection():
-            dc = [clip_vertex1[0]-clip_vertex2[0], clip_vertex1[1]-clip_vertex2[1]]
-            dp = [s[0]-e[0], s[1]-e[1]]
-            n1 = clip_vertex1[0]*clip_vertex2[1] - clip_vertex1[1]*clip_vertex2[0]
-            n2 = s[0]*e[1] - s[1]*e[0]
-            n3 = 1.0 / (dc[0]*dp[1] - dc[1]*dp[0])
-            return [int((n1*dp[0] - n2*dc[0]) * n3), int((n1*dp[1] - n2*dc[1]) * n3)]
+        if self.counters is not None:
+            start = time.time()
+
+        active = []
+        next_edge = 0
+        line = edge_table[0][0]
+        while active or next_edge < len(edge_table):
+            if not active:
+                line = max(line, edge_table[next_edge][0])
+            starting = next_edge
+            while (next_edge < len(edge_table) and
+                   edge_table[next_edge][0] == line):
+                active.append(edge_table[next_edge])
+                next_edge += 1
+
+            if any(edge[1] == line for edge in active):
+                fill([edge for edge in active if edge[1] > line], 0)
+                fill([edge for edge in active if edge[0] < line], 1)
+            else:
+                fill(active, 0)
+                if next_edge > starting:
+                    fill([edge for edge in active if edge[0] < line], 1)
 
-        if not clip:
-            self.poly(vertices, color, fill)
+            line += 1
+            active = [edge for edge in active if edge[1] >= line]
 
-        try:
-            xmin, ymin, xmax, ymax = clip
-        except ValueError:
-            raise ValueError('Clip argument requires 4 elements')
+        if self.counters is not None:
+            self.timings['fill'] += time.time() - start
 
-        clip_vertices = [[xmin, ymin], [xmin, ymax],
-                         [xmax, ymax], [xmax, ymin]]
+    def fill_polys(self, polys, colors, winding='evenodd'):
+        """
+        Fills many polys at once, each with its own color, producing the same
+        pixels as filling each of them in turn with `poly` (outlines are not
+        drawn)
+        The edges of all polys make a single edge table, which is swept
+        from top to bottom, in bands of lines crossed about COMPACT_PIXELS
+        times, all lines of a band at once; the spans of a band are painted
+        in the order polys are given
+        `polys` must be of the form: [[[x1, y1], [x2, y2], ...], ...] and
+        `colors` either a color per poly or a single color
+        """
 
-        output_list = vertices
-        clip_vertex1 = clip_vertices[-1]
+        if winding not in ('evenodd', 'nonzero'):
+            raise ValueError('Winding rule must be either evenodd or nonzero')
+        if isinstance(colors, Color):
+            colors = [colors] * len(polys)
+        elif len(colors) != len(polys):
+            raise ValueError('A color is needed for each poly')
 
-        for clip_vertex in clip_vertices:
-            clip_vertex2 = clip_vertex
-            input_list = output_list
-            output_list = []
-            s = input_list[-1]
+        sizes = numpy.array([len(vertices) for vertices in polys],
+                            dtype=numpy.int64)
+        if not sizes.sum():
+            return
 
-            for vertex in input_list:
-                e = vertex
-                if inside(e):
-                    if not inside(s):
-                        output_list.append(intersection())
-                    output_list.append(e)
-                elif inside(s):
-                    output_list.append(intersection())
-                s = e
-            clip_vertex1 = clip_vertex2
-        return self.poly(output_list, color, fill)
+        if self.counters is not None:
+            start = time.time()
+
+        # Global edge table, in image coordinates, each edge joining a vertex
+        # to the next one of its poly; horizontal edges never cross a line
+        points = self.apply_transforms(
+            [point for vertices in polys for point in vertices])
+        ends = numpy.cumsum(sizes)
+        starts = ends - sizes
+        following = numpy.arange(1, len(points) + 1)
+        following[ends[sizes > 0] - 1] = starts[sizes > 0]
+        x1, y1 = points.T
+        x2, y2 = points[following].T
+        poly = numpy.repeat(numpy.arange(len(polys)), sizes)
+
+        # Each edge crosses lines from its top end to its bottom end (see
+        # `_fill`); only lines of the image are swept
+        tops = numpy.minimum(x1, x2)
+        bottoms = numpy.maximum(x1, x2)
+        edges = tops < bottoms
+        x1, y1, x2, y2 = x1[edges], y1[edges], x2[edges], y2[edges]
+        poly, tops, bottoms = poly[edges], tops[edges], bottoms[edges]
+        if not len(tops):
+            return
+        first = max(int(tops.min()), 0)
+        last = min(int(bottoms.max()), self.height - 1)
+        if first > last:
+            return
 
-    def bezier(self, points, step, color):
+        if self.compact:
+            values = numpy.zeros(len(polys), dtype=numpy.int64)
+        else:
+            values = colors
+
+        crossed = numpy.minimum(bottoms, last) - numpy.maximum(tops, first) + 1
+        bands = max(1, -(-int(numpy.maximum(crossed, 0).sum()) //
+                         COMPACT_PIXELS))
+        band_height = -(-(last - first + 1) // bands)
+        for band_top in range(first, last + 1, band_height):
+            band_bottom = min(band_top + band_height - 1, last)
+            band = (tops <= band_bottom) & (bottoms >= band_top)
+            x, span_y1, span_y2, span_poly = self._sweep(
+                x1[band], y1[band], x2[band], y2[band], poly[band],
+                tops[band], bottoms[band],
+                numpy.maximum(tops[band], band_top),
+                numpy.minimum(bottoms[band], band_bottom),
+                winding == 'nonzero')
+            if not len(x):
+                continue
+
+            # Colors are added as polys get painted, as `poly` would
+            for p in numpy.unique(span_poly).tolist():
+                if self.compact:
+                    if not values[p]:
+                        values[p] = self._index(colors[p])
+                else:
+                    self._check(colors[p])
+                    self.colors.add(colors[p])
+
+            # Spans are sorted by poly, so painting them in turn follows the
+            # order of polys
+            if self.compact:
+                self._paint_spans(x, span_y1, span_y2, values[span_poly])
+            else:
+                pixels = self.pixels
+                for x_, y1_, y2_, p in zip(x.tolist(), span_y1.tolist(),
+                                           span_y2.tolist(),
+                                           span_poly.tolist()):
+                    pixels[x_][y1_:y2_+1] = [values[p]] * (y2_ - y1_ + 1)
+                if self.counters is not None:
+                    self.counters['pixels_written'] += \
+                        int((span_y2 - span_y1 + 1).sum())
+
+            if self._rows is not None:
+                self._dirty.update(numpy.unique(x).tolist())
+
+        if self.counters is not None:
+            self.timings['fill'] += time.time() - start
+
+    def _sweep(self, x1, y1, x2, y2, poly, tops, bottoms, firsts, lasts,
+               nonzero):
         """
-        Draws a colored Bezier curve using `points` as control points and
-        `step` as step size.
-        `points` must be of the form: [[x0, y0], [x1, y1], ...]
+        Returns the spans (x, y1, y2 and poly, as arrays) filling the polys
+        having given edges, with top and bottom ends `tops` and `bottoms`,
+        on lines from firsts to lasts of each edge, sorted by poly; as in
+        `_fill`, lines through vertices are filled both with the edges not
+        ending on them and with the ones not starting on them; spans are
+        clipped to the image
         """
 
-        def bernstein(k, n, y):
-            """
-            Berstein polynomial of n, k as a function of t
-            """
-
-            return comb(n, k) * (t**(n-k)) * (1-t)**k
-
+        heights = numpy.maximum(lasts - firsts + 1, 0)
+        edge = numpy.repeat(numpy.arange(len(firsts)), heights)
+        line = firsts[edge] + numpy.arange(heights.sum()) - \
+            numpy.repeat(numpy.cumsum(heights) - heights, heights)
+        if not len(line):
+            return line, line, line, line
+
+        # Crossings are rounded half away from zero, as `round_away` does
+        crossing = ((line - x1[edge]).astype(float) *
+                    (y2 - y1)[edge] / (x2 - x1)[edge] + y1[edge])
+        crossing = (numpy.sign(crossing) *
+                    numpy.floor(numpy.abs(crossing) + .5)).astype(numpy.int64)
+        direction = numpy.where(x2 > x1, 1, -1)[edge]
+        poly = poly[edge]
+        at_top = line == tops[edge]
+        at_bottom = line == bottoms[edge]
+
+        # Crossings of edges not ending on a line are used for all lines
+        # (rule 0), those of edges not starting on it only for lines through
+        # vertices of the poly (rule 1)
+        lines = int(line.max() - line.min()) + 1
+        poly_line = poly * lines + (line - line.min())
+        through = numpy.isin(poly_line, poly_line[at_top | at_bottom])
+        first_rule = numpy.flatnonzero(~at_bottom)
+        second_rule = numpy.flatnonzero(through & ~at_top)
+        rule = numpy.repeat([0, 1], [len(first_rule), len(second_rule)])
+        vertex = numpy.concatenate((at_top[first_rule],
+                                    at_bottom[second_rule]))
+        kept = numpy.concatenate((first_rule, second_rule))
+        crossing, direction = crossing[kept], direction[kept]
+        line, poly, poly_line = line[kept], poly[kept], poly_line[kept]
+        if not len(line):
+            return line, line, line, line
+
+        # Crossings are sorted by poly, line, rule, position, direction and
+        # whether they are at a vertex, as a single key when it fits in 63
+        # bits
+        positions = int(crossing.max() - crossing.min()) + 1
+        if (int(poly.max()) + 1) * lines * positions * 8 < 1 << 62:
+            order = numpy.argsort(
+                (((poly_line * 2 + rule) * positions +
+                  (crossing - crossing.min())) * 2 + (direction > 0)) * 2 +
+                vertex)
+        else:
+            order = numpy.lexsort((vertex, direction, crossing, rule, line,
+                                   poly))
+        crossing, direction, vertex = \
+            crossing[order], direction[order], vertex[order]
+        line, poly, rule = line[order], poly[order], rule[order]
+
+        # Spans join each crossing to the next one of the same poly, line and
+        # rule, if the line is inside the poly in between, unless both are
+        # the same vertex
+        group = numpy.concatenate(
+            ([True], (line[1:] != line[:-1]) | (poly[1:] != poly[:-1]) |
+                     (rule[1:] != rule[:-1])))
+        group_start = numpy.maximum.accumulate(
+            numpy.where(group, numpy.arange(len(group)), 0))
+        if nonzero:
+            count = numpy.cumsum(direction)
+            inside = count - (count - direction)[group_start] != 0
+        else:
+            inside = (numpy.arange(len(group)) - group_start) % 2 == 0
+        single = (crossing[1:] == crossing[:-1]) & vertex[1:] & vertex[:-1]
+        span = numpy.flatnonzero(inside[:-1] & ~group[1:] & ~single)
+
+        span_y1 = numpy.maximum(crossing[span], 0)
+        span_y2 = numpy.minimum(crossing[span + 1], self.width - 1)
+        visible = span_y1 <= span_y2
+        return (line[span][visible], span_y1[visible], span_y2[visible],
+                poly[span][visible])
+
+    def _paint_spans(self, xs, y1s, y2s, indexes):
+        """
+        Assign pixels (xs[i], y1s[i]) to (xs[i], y2s[i]) of a compact image
+        palette index indexes[i], in order
+        Short spans are painted about COMPACT_PIXELS pixels at a time, the
+        last span being kept where spans of a batch overlap, and long ones
+        as slices, one at a time
+        """
 
-        n_points = len(points)
-        x_points = numpy.array([p[0] for p in points])
-        y_points = numpy.array([p[1] for p in points])
+        lengths = y2s - y1s + 1
+        if self.counters is not None:
+            self.counters['pixels_written'] += int(lengths.sum())
+        ends = numpy.cumsum(lengths)
+        bounds = [0] + numpy.searchsorted(
+            ends, numpy.arange(COMPACT_PIXELS, ends[-1], COMPACT_PIXELS),
+            side='right').tolist() + [len(lengths)]
+        for first, last in zip(bounds, bounds[1:]):
+            if first == last:
+                continue
+            counts = lengths[first:last]
+            if counts.sum() > 16 * (last - first):
+                for x, y1, y2, index in zip(
+                        xs[first:last].tolist(), y1s[first:last].tolist(),
+                        y2s[first:last].tolist(),
+                        indexes[first:last].tolist()):
+                    self.pixels[x, y1:y2+1] = index
+                continue
+
+            span = numpy.repeat(numpy.arange(last - first), counts)
+            ys = y1s[first:last][span] + numpy.arange(counts.sum()) - \
+                numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            xs_ = xs[first:last][span]
+            # Pixels set more than once keep the value of the last span
+            flat = (xs_ * self.width + ys)[::-1]
+            _, kept = numpy.unique(flat, return_index=True)
+            kept = len(flat) - 1 - kept
+            self.pixels[xs_[kept], ys[kept]] = indexes[first:last][span[kept]]
+
+    def _set_span(self, x, y1, y2, color):
+        """
+        Assign pixels (x, y1) to (x, y2) a color, as a single slice; spans are
+        clipped to the image
+        """
 
-        t = numpy.arange(0, 1, step)
+        if not 0 <= x < self.height:
+            return
+        y1 = max(y1, 0)
+        y2 = min(y2, self.width - 1)
+        if y1 > y2:
+            return
 
-        polynomial_array = numpy.array([bernstein(k, n_points-1, t)
-                                        for k in range(n_points)])
+        if self.counters is not None:
+            self.counters['pixels_written'] += y2 - y1 + 1
+        if self._rows is not None:
+            self._dirty.add(x)
 
-        x_bezier = numpy.dot(x_points, polynomial_array)
-        y_bezier = numpy.dot(y_points, polynomial_array)
+        if self.compact:
+            self.pixels[x, y1:y2+1] = self._index(color)
+            return
 
-        bezier_points = zip(x_bezier.astype(int), y_bezier.astype(int))
-        for p1, p2 in zip(bezier_points[:-1], bezier_points[1:]):
-            self.line(p1[0], p1[1], p2[0], p2[1], color)
+        self._check(color)
+        self.colors.add(color)
+        self.pixels[x][y1:y2+1] = [color] * (y2 - y1 + 1)
 
-    def translate(self, x, y):
+    def complex_poly(self, vertices, color, fill=None, clip=None,
+                     winding='evenodd', contours=()):
         """
-        Creates a transform matrix for translating a point to (x, y)
+        Draws a colored poly with lines computed from given vertices,
+        optionally clipping it to a rectangle having its diagonal from
+        (xmin, ymin) to (xmax, ymax) and optionally filling it with given color
+        (see `poly` for the winding rule and further contours)
+        If the poly lies entirely outside the rectangle, None is returned.
+        `vertices` must be of the form: [[x1, y1], [x2, y2], ...]
         """
 
-        self.transforms *= Matrix([[1, 0, x],
-                                   [0, 1, y],
-                                   [0, 0, 1]])
-
-    def rotate(self, x, y, angle):
+        if not clip:
+            return self.poly(vertices, color, fill, winding, contours)
+
+        from clipping import clip_polys
+        if self.counters is not None:
+            start = time.time()
+        # Contours are clipped one by one; within the rectangle, each keeps
+        # its winding around every point
+        contours = [contour for contour in
+                    clip_polys([vertices] + list(contours), clip) if contour]
+        if self.counters is not None:
+            self.counters['polys_clipped'] += 1
+            self.counters['polys_rejected'] += not contours
+            self.timings['clip'] += time.time() - start
+        if not contours:
+            return None
+        return self.poly(contours[0], color, fill, winding, contours[1:])
+
+    def bezier(self, points, step, color, tolerance=None):
         """
-        Creates a transform matrix for rotating a point by given angle (in
-        degrees) around point (x, y)
-        It translates to/from the given point before/after rotation
+        Draws a colored Bezier curve using `points` as control points and
+        `step` as step size.
+        If `tolerance` is given, `step` is ignored and the curve is instead
+        subdivided until each piece is within `tolerance` pixels of a line.
+        `points` must be of the form: [[x0, y0], [x1, y1], ...]
         """
 
-        radians = angle*pi/100
+        if self.counters is not None:
+            start = time.time()
+        curve = bezier_curve(points, step, tolerance)
+        if self.counters is not None:
+            self.counters['bezier_samples'] += len(curve)
+            self.timings['bezier'] += time.time() - start
 
-        self.translate(x, y)
-        self.transforms *= Matrix([[cos(radians), -sin(radians), 0],
-                                   [sin(radians), cos(radians), 0],
-                                   [0, 0, 1]])
-        self.translate(-x, -y)
+        if len(curve) == 1:
+            self.set(curve[0][0], curve[0][1], color)
+        else:
+            self.lines(numpy.column_stack((curve[:-1], curve[1:])), color)
 
-    def scale(self, x, y, xfactor, yfactor):
+    def beziers(self, curves, step, color, tolerance=None):
         """
-        Creates a transform matrix for scaling a point by given factors
-        around point (x, y)
-        It translates to/from the given point before/after scaling
+        Draws many colored Bezier curves at once, producing the same pixels as
+        calling `bezier` for each of them
+        Curves of the same degree are sampled together (see `bezier_curves`)
+        and the lines joining their points are all drawn in one go
+        `curves` must be of the form: [[[x0, y0], [x1, y1], ...], ...]
         """
 
-        self.translate(x, y)
-        self.transforms *= Matrix([[xfactor, 0, 0],
-                                   [0, yfactor, 0],
-                                   [0, 0, 1]])
-        self.translate(-x, -y)
+        if self.counters is not None:
+            start = time.time()
+        points, index = bezier_curves(curves, step, tolerance)
+        if self.counters is not None:
+            self.counters['bezier_samples'] += len(points)
+            self.timings['bezier'] += time.time() - start
 
-    def _apply_transforms(self, x, y):
-        """
-        Applies transforms defined for image on point (x, y), returning the
-        new transformed point's coordinates, converted to integers
-        """
+        # Consecutive points of the same curve are joined, and curves reduced
+        # to a single point draw just that point
+        joined = index[1:] == index[:-1]
+        single = numpy.bincount(index, minlength=len(curves))[index] == 1
+        segments = numpy.concatenate((
+            numpy.column_stack((points[:-1][joined], points[1:][joined])),
+            numpy.hstack((points[single], points[single]))))
 
-        point = Matrix([[x,], [y,], [1,]])
-        transformed_point = self.transforms * point
-        return int(transformed_point[0][0]), int(transformed_point[1][0])
-
-    def reset_transforms(self):
-        self.transforms = Matrix.identity(3)
+        # Lines are drawn in batches, which keeps the per-pixel arrays of
+        # `lines` small whatever the number of curves
+        for start in range(0, len(segments), BEZIER_BATCH):
+            self.lines(segments[start:start + BEZIER_BATCH], color)
 
 
 class Matrix(object):
     def __init__(self, elements):
-        self.elements = elements
-        self.height = len(elements)
-        self.width = len(elements[0])
+        self.elements = [[float(e) for e in row] for row in elements]
+        self.height = len(self.elements)
+        self.width = len(self.elements[0])
+        self._nonzero = None
 
     def __getitem__(self, key):
         return self.elements[key]
@@ -402,33 +1716,40 @@ class Matrix(object):
     def __nonzero__(self):
         """
         Identity matrices are evaluated as False
+        The result is cached until the matrix is multiplied in place
         """
 
-        return self.width != self.height or self != self.identity(self.width)
+        if self._nonzero is None:
+            self._nonzero = (self.width != self.height or
+                             self != self.identity(self.width))
+        return self._nonzero
+
+    __bool__ = __nonzero__
 
     def __mul__(self, other):
         if self.width != other.height:
             raise ValueError('Matrices\'s size is invalid for multiplication')
 
-        result = Matrix.null(self.height, other.width)
-        for i in range(self.height):
-            for j in range(other.width):
-                for k in range(self.width):
-                    result[i][j] += self[i][k] * other[k][j]
-        return result
+        return Matrix(self._product(other))
 
     def __imul__(self, other):
         if self.width != other.height:
             raise ValueError('Matrices\'s size is invalid for multiplication')
 
-        result = Matrix.null(self.height, other.width)
-        for i in range(self.height):
-            for j in range(other.width):
-                for k in range(self.width):
-                    result[i][j] += self[i][k] * other[k][j]
-        self.elements = result.elements
+        self.elements = self._product(other)
+        self.width = other.width
+        self._nonzero = None
         return self
 
+    def _product(self, other):
+        """
+        Returns the elements of the product of the two matrices
+        """
+
+        return [[sum(self[i][k] * other[k][j] for k in range(self.width))
+                 for j in range(other.width)]
+                for i in range(self.height)]
+
     @classmethod
     def null(cls, height, width):
         """
@@ -445,4 +1766,3 @@ class Matrix(object):
 
         return cls(
             [[1 if i==j else 0 for j in range(size)] for i in range(size)])
-